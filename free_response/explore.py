@@ -1,9 +1,13 @@
 import argparse
+import cProfile
+import pstats
+import tracemalloc
 import numpy as np
 
 from src.data import load_cats, load_mnist
 from src.data import quantize, get_color_idxs, add_noise
 from src.em import run_em
+from src.instrument import clear_peak, peak_traced_memory
 from src.potentials import default_J, default_mu
 from src.utils import mean_squared_error, plot_samples
 
@@ -16,16 +20,30 @@ def main():
     parser.add_argument("--noise", type=float, default=0.1)
     parser.add_argument("--n_colors", type=int, default=2)
     parser.add_argument("--n_em_iters", type=int, default=5)
-    parser.add_argument("--n_gibbs_iters", type=int, default=5)
+    parser.add_argument("--n_gibbs_iters", type=int, default=None,
+                        help="Gibbs iterations per EM iteration (default 5), or "
+                             "the cap with --stop_when_converged (default 100)")
     parser.add_argument("--burnin", type=int, default=2)
     parser.add_argument("--sample_every", type=int, default=1)
     parser.add_argument("--beta", type=float, default=1)
     parser.add_argument("--smoothing", type=float, default=1)
+    parser.add_argument("--param_tol", type=float, default=None)
+    parser.add_argument("--pixel_tol", type=float, default=None)
+    parser.add_argument("--n_levels", type=int, default=1)
+    parser.add_argument("--stop_when_converged", action="store_true")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="profile run_em with cProfile and tracemalloc and "
+                             "write the cProfile stats to PATH")
     parser.add_argument("--noshow", action="store_true")
     parser.add_argument("--nosave", action="store_true")
     args = parser.parse_args()
 
+    n_gibbs_iters = args.n_gibbs_iters
+    if n_gibbs_iters is None:
+        n_gibbs_iters = 100 if args.stop_when_converged else 5
+
     np.random.seed(args.seed)
+    rng = np.random.default_rng(int(args.seed))
 
     if args.data == "cats":
         image = load_cats(args.img)
@@ -35,22 +53,38 @@ def main():
     image = quantize(image, args.n_colors)
     image_arr = get_color_idxs(np.array(image), args.n_colors)
 
-    noisy_image = add_noise(image, args.noise, n_colors=args.n_colors)
+    noisy_image = add_noise(image, args.noise, n_colors=args.n_colors, rng=rng)
     noisy_image_arr = get_color_idxs(np.array(noisy_image), n_colors=args.n_colors)
 
     em_args = {
         "n_colors": args.n_colors,
         "n_em_iters": args.n_em_iters,
-        "n_gibbs_iters": args.n_gibbs_iters,
+        "n_gibbs_iters": n_gibbs_iters,
         "burnin": args.burnin,
         "sample_every": args.sample_every,
         "beta": args.beta,
         "J": default_J(args.n_colors),
         "mu": default_mu(args.n_colors),
         "smoothing": args.smoothing,
+        # Keep every Gibbs iteration when we're going to plot them below
+        "keep": "all" if args.n_em_iters == 1 else "thinned",
+        "stop_when_converged": args.stop_when_converged,
+        "param_tol": args.param_tol,
+        "pixel_tol": args.pixel_tol,
+        "n_levels": args.n_levels,
+        "rng": rng,
     }
 
-    samples, extra_info = run_em(noisy_image_arr, **em_args)
+    if args.profile:
+        samples, extra_info = profile_run_em(noisy_image_arr, em_args, args.profile)
+    else:
+        samples, extra_info = run_em(noisy_image_arr, **em_args)
+    for phase, total in extra_info["timings"].items():
+        print(f"{phase:>12}: {total['count']:4d} calls, {total['seconds']:8.3f} s, "
+              f"{total['pixels_per_second']:12,.0f} px/s")
+    for i, diagnostics in enumerate(extra_info.get("diagnostics", [])):
+        print(f"EM iter {i}: {len(diagnostics.energy)} Gibbs iters, "
+              f"converged={diagnostics.converged}, R-hat={diagnostics.split_rhat():.3f}")
 
     # If you only ran one EM iteration, plot out visualization of Gibbs
     # sampling algorithm
@@ -67,5 +101,30 @@ def main():
             n_colors=args.n_colors, show=not args.noshow, save=not args.nosave)
 
 
+def profile_run_em(noisy_image_arr, em_args, path, top=20):
+    """
+    Run `run_em` under cProfile and tracemalloc, save the profile to `path`
+        and print the slowest functions and the lines that allocated the most.
+        `extra_info["timings"]` then also includes the peak bytes per phase.
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    clear_peak()
+    try:
+        samples, extra_info = profiler.runcall(run_em, noisy_image_arr, **em_args)
+        snapshot = tracemalloc.take_snapshot()
+        peak = peak_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    profiler.dump_stats(path)
+    print(f"Wrote cProfile stats to {path}")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+    print(f"Peak traced memory: {peak / 2 ** 20:.1f} MiB; largest allocations:")
+    for stat in snapshot.statistics("lineno")[:top]:
+        print(f"  {stat}")
+    return samples, extra_info
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+"""
+Run `run_em` over a grid of settings in parallel, without plotting.
+
+Run from the root of the repo with, e.g.:
+
+    python -m free_response.sweep --img 0 1 2 --noise 0.1 0.2 --beta 0.5 1 2 \
+        --out sweep.csv
+
+Every option below takes one or more values, and every combination of them
+is one run, set up as `explore.py` would set it up. The runs are spread over
+a pool of worker processes. The images come from the cache of
+`src.dataset.load_dataset`, so each one is decoded and quantized at most once
+rather than once per run. Each run becomes one row of the results, with its
+settings, the MSE of the noisy and of the final image, the number of EM
+iterations, the seconds taken, and the learned J and mu. `--out` writes them
+as JSON if the file name ends in `.json`, and as CSV otherwise, where J and mu
+are JSON strings.
+"""
+
+import argparse
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from src.data import add_noise, color_idxs_to_image, get_color_idxs
+from src.dataset import DATA_ROOT, load_dataset
+from src.em import INFERENCE, run_em
+from src.gibbs import SCHEDULES
+from src.potentials import default_J, default_mu
+from src.utils import mean_squared_error
+
+# Each setting of the grid, with its type and default values (as in explore.py)
+GRID = {
+    "data": (str, ["mnist"]),
+    "img": (int, [0]),
+    "noise": (float, [0.1]),
+    "n_colors": (int, [2]),
+    "seed": (int, [1]),
+    "beta": (float, [1]),
+    "n_em_iters": (int, [5]),
+    "n_gibbs_iters": (int, [5]),
+    "burnin": (int, [2]),
+    "sample_every": (int, [1]),
+    "smoothing": (float, [1]),
+    "inference": (str, ["gibbs"]),
+    "schedule": (str, ["sequential"]),
+    "n_levels": (int, [1]),
+}
+# The settings that are passed straight on to `run_em`
+EM_SETTINGS = ["n_colors", "beta", "n_em_iters", "n_gibbs_iters", "burnin",
+               "sample_every", "smoothing", "inference", "schedule", "n_levels"]
+
+
+def make_grid(grid):
+    """
+    Expand a dictionary from setting names to lists of values into one
+        dictionary per combination, with `GRID`'s defaults for any setting
+        that is missing. The last setting varies fastest.
+    """
+    unknown = set(grid) - set(GRID)
+    assert not unknown, f"Unknown settings {sorted(unknown)}; use {list(GRID)}"
+    values = [grid.get(name, default) for name, (_, default) in GRID.items()]
+    return [dict(zip(GRID, combination)) for combination in itertools.product(*values)]
+
+
+def run_sweep(configs, n_workers=None, root=DATA_ROOT):
+    """
+    Run every configuration from `make_grid` and return its result row, in
+        the same order. With `n_workers=1` the runs happen in this process.
+    """
+    # Build each image cache once, before any worker could race to build it
+    for data, n_colors in sorted({(c["data"], c["n_colors"]) for c in configs}):
+        load_dataset(data, n_colors=n_colors, root=root)
+
+    if n_workers is None:
+        n_workers = min(len(configs), os.cpu_count() or 1)
+    run = functools.partial(run_config, root=root)
+    if n_workers <= 1:
+        return [run(config) for config in configs]
+    with multiprocessing.Pool(n_workers) as pool:
+        return pool.map(run, configs, chunksize=1)
+
+
+def run_config(config, root=DATA_ROOT):
+    """
+    Denoise one image with `run_em` and return its result row.
+    """
+    n_colors = config["n_colors"]
+    np.random.seed(config["seed"])
+    rng = np.random.default_rng(config["seed"])
+    image_arr = _load_images(config["data"], n_colors, root)[config["img"]]
+
+    noisy_image = add_noise(color_idxs_to_image(image_arr, n_colors),
+                            config["noise"], n_colors=n_colors, rng=rng)
+    noisy_image_arr = get_color_idxs(np.array(noisy_image), n_colors=n_colors)
+
+    em_args = {name: config[name] for name in EM_SETTINGS}
+    start = time.perf_counter()
+    samples, extra_info = run_em(noisy_image_arr, J=default_J(n_colors),
+                                 mu=default_mu(n_colors), rng=rng, **em_args)
+    seconds = time.perf_counter() - start
+
+    return dict(
+        config,
+        noisy_mse=float(mean_squared_error(image_arr, noisy_image_arr)),
+        mse=float(mean_squared_error(image_arr, samples[-1])),
+        n_em_iters_run=len(samples),
+        seconds=seconds,
+        J=np.asarray(extra_info["J"]).tolist(),
+        mu=np.asarray(extra_info["mu"]).tolist(),
+    )
+
+
+def write_results(rows, path):
+    """
+    Save result rows to `path`, as JSON if it ends in `.json` and as CSV
+        otherwise.
+    """
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=2)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: json.dumps(value) if isinstance(value, list) else value
+                             for key, value in row.items()})
+
+
+@functools.lru_cache(maxsize=None)
+def _load_images(data, n_colors, root):
+    """
+    The memory-mapped color indices of every image in a dataset, opened once
+        per process.
+    """
+    return load_dataset(data, n_colors=n_colors, root=root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    for name, (kind, default) in GRID.items():
+        choices = {"data": ["cats", "mnist"], "inference": INFERENCE,
+                   "schedule": SCHEDULES}.get(name)
+        parser.add_argument(f"--{name}", nargs="+", type=kind, default=default,
+                            choices=choices)
+    parser.add_argument("--grid", metavar="PATH",
+                        help="a JSON file mapping any of the settings above to "
+                             "a list of values, which replaces their values")
+    parser.add_argument("--n_workers", type=int, default=None)
+    parser.add_argument("--root", default=DATA_ROOT)
+    parser.add_argument("--out", default="sweep.csv")
+    args = parser.parse_args()
+
+    grid = {name: vars(args)[name] for name in GRID}
+    if args.grid:
+        with open(args.grid) as f:
+            grid.update(json.load(f))
+    configs = make_grid(grid)
+    print(f"Running {len(configs)} configurations")
+
+    start = time.perf_counter()
+    rows = run_sweep(configs, n_workers=args.n_workers, root=args.root)
+    write_results(rows, args.out)
+    print(f"Wrote {len(rows)} results to {args.out} "
+          f"in {(time.perf_counter() - start) / 60:.2f} min")
+
+
+if __name__ == "__main__":
+    main()
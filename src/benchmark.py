@@ -0,0 +1,265 @@
+"""
+Speed benchmarks for the potentials, the Gibbs sampler and EM.
+
+Run from the root of the repo with, e.g.:
+
+    python -m src.benchmark --sizes 28 256 1024 2048 --out bench.json
+    python -m src.benchmark --quick --baseline bench.json
+
+Each result reports pixels per second (for the per-pixel functions, pixel
+conditionals or lookups per second) and the peak memory NumPy allocated while
+the benchmark ran, as measured by `tracemalloc`. With `--baseline`, results
+more than `--tolerance` slower than the matching baseline entry are flagged
+and the command exits with status 1.
+"""
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+
+from src.em import run_em
+from src.gibbs import run_gibbs, get_expected_image
+from src.potentials import (default_J, default_mu, calculate_J, calculate_mu,
+                            ising_potential, potts_potential)
+from src.utils import get_neighbors
+
+SIZES = [28, 256, 1024, 2048]
+QUICK_SIZES = [28, 128]
+N_COLORS = [2, 4, 8]
+# How many pixels the per-pixel functions are called on
+N_PIXEL_CALLS = 2000
+# Sequential sweeps loop over pixels in Python; skip them on large images
+MAX_SEQUENTIAL_SIZE = 128
+# EM runs several sweeps per iteration; skip it on the largest images
+MAX_EM_SIZE = 1024
+
+
+def bench_get_neighbors(arr, noisy, n_colors, rng):
+    pixels = _random_pixels(arr.shape, rng)
+    for i, j in pixels:
+        get_neighbors(arr, i, j)
+    return len(pixels)
+
+
+def bench_ising_potential(arr, noisy, n_colors, rng):
+    if n_colors != 2:
+        return None
+    pixels = _random_pixels(arr.shape, rng)
+    J, mu = default_J(2), default_mu(2)
+    for i, j in pixels:
+        ising_potential(arr, i, j, noisy[i, j], J=J, mu=mu)
+    return len(pixels)
+
+
+def bench_potts_potential(arr, noisy, n_colors, rng):
+    pixels = _random_pixels(arr.shape, rng)
+    J, mu = default_J(n_colors), default_mu(n_colors)
+    for i, j in pixels:
+        potts_potential(arr, i, j, noisy[i, j], J=J, mu=mu, n_colors=n_colors)
+    return len(pixels)
+
+
+def bench_gibbs_sequential(arr, noisy, n_colors, rng):
+    if arr.shape[0] > MAX_SEQUENTIAL_SIZE:
+        return None
+    run_gibbs(noisy, 1, n_colors=n_colors, J=default_J(n_colors),
+              mu=default_mu(n_colors), keep="last", rng=rng)
+    return noisy.size
+
+
+def bench_gibbs_checkerboard(arr, noisy, n_colors, rng):
+    n_iter = 5
+    run_gibbs(noisy, n_iter, n_colors=n_colors, J=default_J(n_colors),
+              mu=default_mu(n_colors), schedule="checkerboard", keep="last",
+              rng=rng)
+    return n_iter * noisy.size
+
+
+def bench_get_expected_image(arr, noisy, n_colors, rng):
+    n_samples = 10
+    samples = [noisy] * n_samples
+    get_expected_image(samples, burnin=0)
+    return n_samples * noisy.size
+
+
+def bench_calculate_J(arr, noisy, n_colors, rng):
+    calculate_J(arr, n_colors=n_colors)
+    return arr.size
+
+
+def bench_calculate_mu(arr, noisy, n_colors, rng):
+    calculate_mu(noisy, arr, n_colors=n_colors)
+    return arr.size
+
+
+def bench_run_em(arr, noisy, n_colors, rng):
+    if arr.shape[0] > MAX_EM_SIZE:
+        return None
+    n_em_iters, n_gibbs_iters = 2, 3
+    run_em(noisy, n_colors=n_colors, n_em_iters=n_em_iters,
+           n_gibbs_iters=n_gibbs_iters, burnin=1, sample_every=1,
+           J=default_J(n_colors), mu=default_mu(n_colors),
+           schedule="checkerboard", rng=rng)
+    return n_em_iters * n_gibbs_iters * noisy.size
+
+
+# Each benchmark runs once on a clean image and its noisy copy, and returns
+#   how many pixels it processed, or None if it doesn't apply to that case
+BENCHMARKS = {
+    "get_neighbors": bench_get_neighbors,
+    "ising_potential": bench_ising_potential,
+    "potts_potential": bench_potts_potential,
+    "run_gibbs_sequential": bench_gibbs_sequential,
+    "run_gibbs_checkerboard": bench_gibbs_checkerboard,
+    "get_expected_image": bench_get_expected_image,
+    "calculate_J": bench_calculate_J,
+    "calculate_mu": bench_calculate_mu,
+    "run_em": bench_run_em,
+}
+
+
+def make_images(size, n_colors, rng, noise=0.1):
+    """
+    A blocky `size` x `size` test image with `n_colors` colors and a copy
+        with a fraction `noise` of its pixels recolored at random.
+    """
+    block = max(1, size // 8)
+    coarse = rng.integers(0, n_colors, size=(size // block + 1,) * 2)
+    arr = np.repeat(np.repeat(coarse, block, 0), block, 1)[:size, :size]
+    arr = arr.astype(np.uint8)
+    flip = rng.random(arr.shape) < noise
+    noisy = np.where(flip, rng.integers(0, n_colors, size=arr.shape), arr)
+    return arr, noisy.astype(np.uint8)
+
+
+def run_benchmarks(names=None, sizes=SIZES, n_colors_list=N_COLORS,
+                   repeats=3, seed=0):
+    """
+    Time each benchmark on each image size and number of colors.
+
+    Args:
+        names: which entries of `BENCHMARKS` to run; defaults to all
+        sizes: side lengths of the square test images
+        n_colors_list: numbers of colors to test
+        repeats: timing runs per case; the fastest is reported
+        seed: seeds the test images and the samplers
+
+    Returns:
+        a list of result dictionaries with the benchmark `name`, `size`,
+        `n_colors`, best wall time in `seconds`, `pixels_per_second` and
+        `peak_bytes`
+    """
+    results = []
+    for name in names or list(BENCHMARKS):
+        bench = BENCHMARKS[name]
+        for size in sizes:
+            for n_colors in n_colors_list:
+                arr, noisy = make_images(size, n_colors, np.random.default_rng(seed))
+
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    n_pixels = bench(arr, noisy, n_colors, np.random.default_rng(seed))
+                    times.append(time.perf_counter() - start)
+                    if n_pixels is None:
+                        break
+                if n_pixels is None:
+                    continue
+
+                # Memory is measured on a separate run, since tracing slows it
+                tracemalloc.start()
+                bench(arr, noisy, n_colors, np.random.default_rng(seed))
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                seconds = min(times)
+                results.append({
+                    "name": name, "size": size, "n_colors": n_colors,
+                    "seconds": seconds,
+                    "pixels_per_second": n_pixels / max(seconds, 1e-12),
+                    "peak_bytes": peak,
+                })
+                print(_format_result(results[-1]), flush=True)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Match results to baseline entries with the same name, size and number of
+        colors, and flag any whose throughput dropped by more than
+        `tolerance` (as a fraction of the baseline).
+
+    Returns:
+        a list of `(result, baseline_result, ratio)` tuples for the
+        regressions, where `ratio` is the new over the old pixels per second
+    """
+    old = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        if _key(result) not in old:
+            continue
+        ratio = result["pixels_per_second"] / old[_key(result)]["pixels_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append((result, old[_key(result)], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--names", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--n_colors", nargs="+", type=int, default=N_COLORS)
+    parser.add_argument("--quick", action="store_true",
+                        help=f"only use image sizes {QUICK_SIZES}")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else args.sizes
+    results = run_benchmarks(args.names, sizes, args.n_colors,
+                             repeats=args.repeats, seed=args.seed)
+    report = {
+        "meta": {"numpy": np.__version__, "python": platform.python_version(),
+                 "machine": platform.machine(), "time": time.time()},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for result, _, ratio in regressions:
+            print(f"REGRESSION {_format_result(result)} ({ratio:.2f}x baseline)")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions against the baseline")
+
+
+def _random_pixels(shape, rng):
+    rows = rng.integers(0, shape[0], size=N_PIXEL_CALLS)
+    cols = rng.integers(0, shape[1], size=N_PIXEL_CALLS)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def _key(result):
+    return (result["name"], result["size"], result["n_colors"])
+
+
+def _format_result(result):
+    return (f"{result['name']:<24} {result['size']:>5}px^2 "
+            f"{result['n_colors']} colors: "
+            f"{result['pixels_per_second']:>12,.0f} px/s, "
+            f"peak {result['peak_bytes'] / 2 ** 20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import numpy as np
+
+from src.potentials import check_params
+from src.utils import get_neighborhood
+
+SCHEDULES = ["parallel", "checkerboard"]
+MODES = ["sum", "max"]
+
+
+def run_bp(noisy_arr, n_colors=2, beta=1, J=None, mu=None, n_iter=50,
+           tol=1e-4, damping=0.5, mode="sum", schedule="parallel",
+           init=None):
+    """
+    Run loopy belief propagation on the 4-connected grid.
+
+    The model is the joint distribution whose conditionals `potts_potential`
+        computes: a pairwise factor exp(beta * J[a, b]) on each pair of
+        neighbors (with J symmetrized, as in `image_energy`) and a factor
+        exp(beta * mu[k, orig]) on each pixel. Messages are kept in log
+        space as an array of shape `(4,) + noisy_arr.shape + (n_colors,)`,
+        where `messages[d]` holds the message each pixel receives from its
+        neighbor in direction d (up, left, down, right, as in
+        `src.utils.OFFSETS`). Messages from outside the image stay zero.
+
+    Args:
+        noisy_arr: the observed noisy image, or a 3D stack of images
+        n_colors: the number of colors
+        beta, J, mu: hyperparameters, as in `potts_potential`. For a stack
+            of N images, J and mu may also be `(N, n_colors, n_colors)`.
+        n_iter: the maximum number of message-passing sweeps
+        tol: stop once no log-message changes by more than `tol` in a sweep
+        damping: the weight kept on the old log-messages in each update,
+            from 0 up to, but not including, 1
+        mode: "sum" for sum-product, whose beliefs approximate the
+            marginals, or "max" for max-product, whose beliefs are
+            max-marginals and whose argmax approximates the MAP image
+        schedule: "parallel" updates every message at once; "checkerboard"
+            updates the messages into one half of the grid, then the other
+        init: optional starting log-messages, e.g. `info["messages"]` from
+            an earlier call
+
+    Returns:
+        image: the uint8 argmax of the beliefs, of the same shape as
+            `noisy_arr`
+        beliefs: array of shape `noisy_arr.shape + (n_colors,)` where
+            `beliefs[..., k]` is the normalized belief that a pixel has
+            color k
+        info: a dictionary with the number of sweeps run (`n_iter`), the
+            largest change in each sweep (`deltas`), whether the messages
+            converged within `tol` (`converged`), and the final log-messages
+            (`messages`)
+    """
+    assert schedule in SCHEDULES, f"schedule must be one of {SCHEDULES}"
+    assert mode in MODES, f"mode must be one of {MODES}"
+    assert 0 <= damping < 1
+    J, mu = check_params(J, mu, n_colors, batch_shape=noisy_arr.shape[:-2])
+    neighborhood = get_neighborhood(noisy_arr.shape[-2:])
+    assert len(neighborhood.offsets) == 4
+
+    pairwise = beta * (J + np.swapaxes(J, -1, -2)) / 2
+    if mu.ndim == 2:
+        unary = beta * mu.T[noisy_arr]
+    else:
+        image_idx = np.arange(mu.shape[0]).reshape(-1, 1, 1)
+        unary = beta * np.swapaxes(mu, -1, -2)[image_idx, noisy_arr]
+    # Broadcast a per-image pairwise table over the pixel axes
+    if pairwise.ndim == 3:
+        pairwise = pairwise[:, None, None]
+
+    shape = (4,) + noisy_arr.shape + (n_colors,)
+    if init is None:
+        messages = np.zeros(shape)
+    else:
+        assert init.shape == shape
+        messages = init.astype(float)
+
+    halves = [None]
+    if schedule == "checkerboard":
+        ii, jj = np.indices(noisy_arr.shape[-2:])
+        halves = [(ii + jj) % 2 == 0, (ii + jj) % 2 == 1]
+
+    deltas = []
+    converged = False
+    for _ in range(n_iter):
+        old = messages.copy()
+        for half in halves:
+            new = _update_messages(messages, unary, pairwise, neighborhood, mode)
+            new = damping * messages + (1 - damping) * new
+            if half is None:
+                messages = new
+            else:
+                messages[..., half, :] = new[..., half, :]
+
+        deltas.append(np.max(np.abs(messages - old)))
+        if deltas[-1] < tol:
+            converged = True
+            break
+
+    beliefs = unary + messages.sum(axis=0)
+    beliefs = np.exp(beliefs - beliefs.max(axis=-1, keepdims=True))
+    beliefs /= beliefs.sum(axis=-1, keepdims=True)
+    image = np.argmax(beliefs, axis=-1).astype(np.uint8)
+    info = {"n_iter": len(deltas), "deltas": deltas, "converged": converged,
+            "messages": messages}
+    return image, beliefs, info
+
+
+def _update_messages(messages, unary, pairwise, neighborhood, mode):
+    """
+    Compute every new log-message from the current ones. The message pixel p
+        gets from its neighbor q combines q's unary factor with everything q
+        received except what p sent it, passed through the pairwise factor.
+    """
+    total = unary + messages.sum(axis=0)
+    new = np.zeros_like(messages)
+    last = (slice(None),)
+    for d, (dst, src) in enumerate(neighborhood.slices()):
+        # p's message to q arrived at q from the opposite direction
+        outgoing = (total - messages[(d + 2) % 4])[(Ellipsis,) + src + last]
+        # scores[..., a, b] = pairwise[a, b] + outgoing[..., b]
+        scores = outgoing[..., None, :] + pairwise
+        message = scores.max(axis=-1)
+        if mode == "sum":
+            message = message + np.log(
+                np.sum(np.exp(scores - message[..., None]), axis=-1))
+        new[d][(Ellipsis,) + dst + last] = message - message.max(axis=-1, keepdims=True)
+    return new
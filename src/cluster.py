@@ -0,0 +1,120 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from src.potentials import check_params, normalize_scores, sample_colors
+from src.utils import get_rng, grid_edges
+
+
+def swendsen_wang_sweep(arr, orig_arr, n_colors=2, beta=1, J=None, mu=None,
+                        rng=None):
+    """
+    Update `arr` in place with one Swendsen-Wang cluster move.
+
+    This uses the Edwards-Sokal representation of the model whose pairwise
+        potential is the symmetrized J (which matches the Gibbs conditionals
+        whenever J is symmetric, as `default_J` is). Write each edge weight
+        exp(beta * J[a, b]) as r(a, b) plus, for equal colors, a bond term
+        q(a) = exp(beta * J[a, a]) - exp(beta * m), where r(a, a) = exp(beta * m)
+        and m is the largest off-diagonal entry of J (capped at the smallest
+        diagonal entry so q(a) >= 0). Then:
+
+    1. Bond each pair of equal neighbors of color a with probability
+       1 - exp(-beta * (J[a, a] - m)).
+    2. Label the connected components of the bond graph.
+    3. Give each cluster a new color drawn from its exact conditional: the
+       external field mu over its pixels, q(c) for each of its bonds, and
+       r(c, .) for each unbonded edge leaving the cluster.
+
+    For a plain Potts J (constant off-diagonal), r is constant, so every
+        cluster can be recolored at once. Otherwise clusters that share an
+        edge are recolored in separate rounds, using random priorities to
+        pick non-adjacent clusters each round, which keeps the move exact.
+
+    Args:
+        arr: the current 2D state, or a stack of states, updated in place
+        orig_arr: the observed noisy image(s), same shape as `arr`
+        n_colors, beta, J, mu: as in `potts_conditionals`. For a stack,
+            per-image `(N, n_colors, n_colors)` J and mu are also accepted.
+        rng: the `np.random.Generator` to draw from (see `get_rng`)
+    """
+    rng = get_rng(rng)
+    J, mu = check_params(J, mu, n_colors, batch_shape=arr.shape[:-2])
+    if J.ndim == 3 or mu.ndim == 3:
+        for n in range(arr.shape[0]):
+            swendsen_wang_sweep(arr[n], orig_arr[n], n_colors, beta,
+                                J[n] if J.ndim == 3 else J,
+                                mu[n] if mu.ndim == 3 else mu, rng=rng)
+        return
+
+    J = (J + J.T) / 2
+    off_diagonal = J[~np.eye(n_colors, dtype=bool)]
+    m = min(off_diagonal.max(), np.diag(J).min()) if n_colors > 1 else J[0, 0]
+    gap = beta * (np.diag(J) - m)
+
+    # 1. Bonds between equal neighbors
+    flat = arr.reshape(-1)
+    first, second = grid_edges(arr.shape)
+    colors = flat[first]
+    bond_prob = -np.expm1(-gap)
+    bonded = (colors == flat[second]) & (
+        rng.random(colors.shape) < bond_prob[colors])
+
+    # 2. Clusters
+    n_pixels = flat.size
+    graph = coo_matrix((np.ones(bonded.sum()), (first[bonded], second[bonded])),
+                       shape=(n_pixels, n_pixels))
+    n_clusters, labels = connected_components(graph, directed=False)
+
+    # 3. Cluster scores that don't depend on other clusters' colors
+    field = np.stack([np.bincount(labels, weights=beta * mu[c, orig_arr.reshape(-1)],
+                                  minlength=n_clusters)
+                      for c in range(n_colors)], axis=-1)
+    n_bonds = np.bincount(labels[first[bonded]], minlength=n_clusters)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # log q(c), which is -inf for colors that can never be bonded
+        log_bond = beta * np.diag(J) + np.log(-np.expm1(-gap))
+        scores = field + np.where(n_bonds[:, None] > 0,
+                                  n_bonds[:, None] * log_bond, 0)
+
+    residual = beta * J.copy()
+    np.fill_diagonal(residual, beta * m)
+    crossing = labels[first] != labels[second]
+    edge_a, edge_b = labels[first[crossing]], labels[second[crossing]]
+    pixel_a, pixel_b = first[crossing], second[crossing]
+
+    new_colors = np.zeros(n_clusters, dtype=flat.dtype)
+    if np.ptp(residual) < 1e-12:
+        new_colors[:] = sample_colors(normalize_scores(scores), rng)
+    else:
+        # The current color of each cluster; all pixels in a cluster share it
+        new_colors[labels] = flat
+        todo = np.ones(n_clusters, dtype=bool)
+        while todo.any():
+            chosen = _independent_clusters(todo, edge_a, edge_b, rng)
+            boundary = np.zeros((n_clusters, n_colors))
+            for c in range(n_colors):
+                boundary[:, c] = (
+                    np.bincount(edge_a, residual[c, new_colors[labels[pixel_b]]],
+                                minlength=n_clusters)
+                    + np.bincount(edge_b, residual[c, new_colors[labels[pixel_a]]],
+                                  minlength=n_clusters))
+            probs = normalize_scores(scores[chosen] + boundary[chosen])
+            new_colors[chosen] = sample_colors(probs, rng)
+            todo &= ~chosen
+
+    arr[...] = new_colors[labels].reshape(arr.shape)
+
+
+def _independent_clusters(todo, edge_a, edge_b, rng):
+    """
+    Pick a set of clusters from `todo` no two of which share an edge: each
+        cluster draws a random priority and is chosen if it beats every
+        neighboring cluster still in `todo`.
+    """
+    priority = np.where(todo, rng.random(todo.shape), -1.0)
+    best_neighbor = np.full(todo.shape, -1.0)
+    np.maximum.at(best_neighbor, edge_a, priority[edge_b])
+    np.maximum.at(best_neighbor, edge_b, priority[edge_a])
+    return todo & (priority > best_neighbor)
+
@@ -1,7 +1,6 @@
 # Dataset loading functions. Don't edit this file.
 
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
@@ -47,10 +46,11 @@ def load_mnist(i=None):
 
 def get_color_idxs(arr, n_colors=2):
     """
-    Take a greyscale image with 256 colors and map it down to `n_colors` ids
+    Take a greyscale image with 256 colors and map it down to `n_colors` ids,
+    stored as uint8 to keep images one byte per pixel
     """
     k = 256 // (n_colors - 1)
-    idxs = np.round(arr / k).astype(int)
+    idxs = np.round(arr / k).astype(np.uint8)
     return idxs
 
 
@@ -60,7 +60,7 @@ def color_idxs_to_image(color_idxs, n_colors=2):
     back into a 256 greyscale format.
     """
     k = 256 // (n_colors - 1)
-    arr = np.clip(k * color_idxs, 0, 255)
+    arr = np.clip(k * np.asarray(color_idxs, dtype=int), 0, 255)
     return Image.fromarray(arr.astype(np.uint8), mode="L")
 
 
@@ -74,6 +74,9 @@ def quantize(image, num_colors=5):
 
 
 def display_image(image, n_colors, size=(128, 128), title=None):
+    # Imported here so that loading data doesn't pay for matplotlib
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(8, 8))
     new_image = image.resize(size, resample=Image.Resampling.NEAREST)
     new_image = quantize(new_image, n_colors)
@@ -85,21 +88,27 @@ def display_image(image, n_colors, size=(128, 128), title=None):
     plt.close(fig)
 
 
-def add_noise(image, prob=0.1, n_colors=2):
+def add_noise(image, prob=0.1, n_colors=2, rng=None):
     """
     Change each pixel in the image independently with probability `prob`.
     You shouldn't need to change this function.
+
+    Draws from `rng`, a `np.random.Generator`, if given, and otherwise from
+    the global `np.random` state.
     """
     arr = np.array(image.convert("L"))
     colors = np.unique(arr)
     n_colors = colors.shape[0]
 
     # each color, including original, has a `1/num_colors` chance
-    random_sample = np.random.randint(0, n_colors, size=arr.shape)
+    if rng is None:
+        random_sample = np.random.randint(0, n_colors, size=arr.shape)
+    else:
+        random_sample = rng.integers(0, n_colors, size=arr.shape)
 
     # so we set `swap_prob` > `prob`
     swap_prob = min(1, (n_colors / (n_colors - 1)) * prob)
-    swap = np.random.binomial(n=1, p=swap_prob, size=arr.shape)
+    swap = (np.random if rng is None else rng).binomial(n=1, p=swap_prob, size=arr.shape)
 
     arr = (1 - swap) * arr + swap * colors[random_sample]
     return Image.fromarray(arr.astype(np.uint8), mode="L")
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import numpy as np
+from PIL import Image
+
+from src.data import get_color_idxs, quantize
+
+DATA_ROOT = "data"
+IMAGE_EXTENSIONS = (".png",)
+
+
+def list_images(name, root=DATA_ROOT):
+    """
+    Find every image in the folder `root/name`, however many there are.
+
+    Returns:
+        a list of paths, ordered by the number in each file name (so
+            `2.png` comes before `10.png`) and then by name
+    """
+    folder = os.path.join(root, name)
+    if not os.path.isdir(folder):
+        msg = "Follow the Data setup instructions in data/README.md: missing '{}'"
+        raise IOError(msg.format(name))
+    files = [f for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return [os.path.join(folder, f) for f in sorted(files, key=_image_order)]
+
+
+def load_dataset(name, n_colors=None, root=DATA_ROOT, cache_dir=None):
+    """
+    Load every image in `root/name` as one `(N, height, width)` uint8 array.
+
+    The first call decodes the images one at a time into a `.npy` cache,
+        next to a manifest with each file's name, size and modification time.
+        Later calls only compare the manifest against the folder and then
+        memory-map the cache, so nothing is decoded again unless an image
+        was added, removed or changed.
+
+    Args:
+        name: the folder under `root`, e.g. "cats" or "mnist"
+        n_colors: if given, cache each image's color indices after
+            `quantize`, as `get_color_idxs` returns them; otherwise cache the
+            greyscale values
+        root: the data folder
+        cache_dir: where to keep the cache; defaults to `root/.cache`
+
+    Returns:
+        a read-only `np.memmap` of shape `(N, height, width)`. All images
+        in the folder must have the same size.
+    """
+    paths = list_images(name, root)
+    assert len(paths) > 0, f"No images in {os.path.join(root, name)}"
+    manifest = [[os.path.basename(path), os.stat(path).st_mtime_ns,
+                 os.stat(path).st_size] for path in paths]
+
+    if cache_dir is None:
+        cache_dir = os.path.join(root, ".cache")
+    stem = name if n_colors is None else f"{name}_{n_colors}_colors"
+    array_path = os.path.join(cache_dir, stem + ".npy")
+    manifest_path = os.path.join(cache_dir, stem + ".json")
+
+    if not os.path.isfile(array_path) or _read_manifest(manifest_path) != manifest:
+        os.makedirs(cache_dir, exist_ok=True)
+        _build_cache(paths, array_path, n_colors)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+    return np.load(array_path, mmap_mode="r")
+
+
+def _build_cache(paths, array_path, n_colors):
+    """
+    Decode `paths` one at a time into a new `.npy` file at `array_path`. The
+        file is written under a temporary name and then moved into place, so
+        an interrupted build never leaves a partial cache behind.
+    """
+    first = _decode(paths[0], n_colors)
+    tmp_path = array_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                    shape=(len(paths),) + first.shape)
+    try:
+        out[0] = first
+        for i, path in enumerate(paths[1:], start=1):
+            arr = _decode(path, n_colors)
+            if arr.shape != first.shape:
+                raise ValueError(f"{path} has shape {arr.shape}, "
+                                 f"but {paths[0]} has shape {first.shape}")
+            out[i] = arr
+        out.flush()
+        del out
+        os.replace(tmp_path, array_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _decode(path, n_colors):
+    """
+    Read one image as greyscale, or as color indices if `n_colors` is given.
+    """
+    with Image.open(path) as image:
+        if n_colors is None:
+            return np.array(image.convert("L"))
+        return get_color_idxs(np.array(quantize(image, n_colors)), n_colors)
+
+
+def _read_manifest(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _image_order(filename):
+    stem = os.path.splitext(filename)[0]
+    number = re.fullmatch(r"\d+", stem)
+    return (0, int(stem), filename) if number else (1, 0, filename)
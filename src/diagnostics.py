@@ -0,0 +1,162 @@
+import numpy as np
+
+from src.potentials import image_energy
+
+# `split_rhat` splits the second half of each trace into two pieces of at
+#   least two sweeps, so no chain can converge in fewer sweeps than this
+MIN_RHAT_ITER = 8
+
+
+class GibbsDiagnostics:
+    """
+    Per-sweep convergence diagnostics for `run_gibbs`.
+
+    Pass one to `run_gibbs(diagnostics=...)` and it is updated in place after
+        every sweep, like `ColorCounts`. It records the energy of the state
+        (see `src.potentials.image_energy`) and the fraction of pixels that
+        changed. From the energy trace it computes split-R-hat, which also
+        pools any chains merged in from `run_gibbs(n_chains=...)`, and a
+        Geweke z-score.
+
+    With `run_gibbs(stop_when_converged=True)` the chain stops as soon as the
+        second half of the energy trace looks stationary: split-R-hat below
+        `rhat_threshold` once at least `min_iter` sweeps have run. The first
+        half is then treated as burn-in. With a cap on the number of sweeps,
+        use `reachable_min_iter` so the rule can trigger before the cap.
+
+    With `run_gibbs(n_chains=...)`, each chain runs in its own process and
+        stops on its own single-chain split-R-hat; the chains are only pooled
+        when they are merged afterwards. `split_rhat` on the merged object
+        then compares across chains, and `converged` is True only if every
+        chain converged, but the pooled value never stopped any chain.
+
+    Args:
+        rhat_threshold: the split-R-hat value below which the chain counts
+            as converged
+        min_iter: never declare convergence before this many sweeps
+
+    Attributes:
+        energy: list with the energy after each sweep (an array of one energy
+            per image for a stack of images)
+        flip_fraction: list with the fraction of pixels changed by each sweep
+        chains: diagnostics from other chains merged in with `merge`
+        burnin: the number of sweeps treated as burn-in, set when the chain
+            stops under `stop_when_converged`
+        converged: whether the convergence criterion was met
+    """
+
+    def __init__(self, rhat_threshold=1.05, min_iter=20):
+        self.rhat_threshold = rhat_threshold
+        self.min_iter = min_iter
+        self.energy = []
+        self.flip_fraction = []
+        self.chains = []
+        self.burnin = None
+        self.converged = False
+
+    def update(self, arr, prev_arr, orig_arr, J=None, mu=None, n_colors=2):
+        """
+        Record one sweep that moved the chain from `prev_arr` to `arr`.
+        """
+        self.energy.append(image_energy(arr, orig_arr, J=J, mu=mu,
+                                        n_colors=n_colors))
+        self.flip_fraction.append(np.mean(arr != prev_arr))
+
+    def merge(self, other):
+        """
+        Add another chain's diagnostics so `split_rhat` compares across chains.
+        """
+        self.chains.append(other)
+        self.converged = all(chain.converged for chain in self._traced())
+
+    def empty_copy(self):
+        """
+        A fresh object with the same settings and no recorded sweeps.
+        """
+        return GibbsDiagnostics(self.rhat_threshold, self.min_iter)
+
+    def split_rhat(self):
+        """
+        Split-R-hat of the energy over the second half of each chain's trace.
+            Each half-trace is split in two again, and the R-hat statistic
+            compares the variance between these pieces to the variance
+            within them. Values near 1 suggest the chains have mixed.
+
+        Returns:
+            a float; for a stack of images, the largest value over the images
+        """
+        pieces = []
+        for chain in self._traced():
+            trace = np.asarray(chain.energy, dtype=float)
+            n = len(trace) // 4
+            if n < 2:
+                return np.inf
+            second_half = trace[len(trace) - 2 * n:]
+            pieces.extend([second_half[:n], second_half[n:]])
+        n = min(len(piece) for piece in pieces)
+        return np.max(split_rhat(np.stack([piece[-n:] for piece in pieces])))
+
+    def geweke(self, first=0.1, last=0.5):
+        """
+        Geweke z-score comparing the mean energy over the first `first`
+            fraction and the last `last` fraction of this chain's trace.
+            Variances are the plain sample variances, so the score is
+            optimistic for strongly autocorrelated traces.
+
+        Returns:
+            a float, or one score per image for a stack of images
+        """
+        trace = np.asarray(self.energy, dtype=float)
+        n_first = max(2, int(first * len(trace)))
+        n_last = max(2, int(last * len(trace)))
+        a, b = trace[:n_first], trace[len(trace) - n_last:]
+        spread = np.sqrt(a.var(axis=0, ddof=1) / len(a) + b.var(axis=0, ddof=1) / len(b))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (a.mean(axis=0) - b.mean(axis=0)) / spread
+        return np.where(spread > 0, z, 0.0)
+
+    def _traced(self):
+        """
+        This chain and every merged chain that has recorded any sweeps.
+        """
+        return [chain for chain in [self] + self.chains if len(chain.energy)]
+
+    def check(self):
+        """
+        Test the stopping rule after the latest sweep. On success, mark the
+            chain converged and treat the first half of it as burn-in.
+        """
+        n_sweeps = len(self.energy)
+        if n_sweeps >= self.min_iter and self.split_rhat() < self.rhat_threshold:
+            self.converged = True
+            self.burnin = n_sweeps // 2
+        return self.converged
+
+
+def reachable_min_iter(n_iter, min_iter=20):
+    """
+    A `min_iter` that a chain capped at `n_iter` sweeps can reach before the
+        cap: `min_iter` or half the cap, whichever is smaller, but at least
+        `MIN_RHAT_ITER`. Returns `min_iter` itself if there is no cap.
+    """
+    if n_iter is None:
+        return min_iter
+    return max(MIN_RHAT_ITER, min(min_iter, n_iter // 2))
+
+
+def split_rhat(traces):
+    """
+    The (potential scale reduction) R-hat statistic for `m` traces of length
+        `n`, given as an array of shape `(m, n)` or `(m, n, ...)`.
+
+    Traces that never move (zero within-trace variance) get 1 if they all
+        agree and infinity otherwise.
+    """
+    traces = np.asarray(traces, dtype=float)
+    n = traces.shape[1]
+    within = traces.var(axis=1, ddof=1).mean(axis=0)
+    between = n * traces.mean(axis=1).var(axis=0, ddof=1)
+    pooled = (n - 1) / n * within + between / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rhat = np.sqrt(pooled / within)
+    return np.where(within > 0, rhat, np.where(between > 0, np.inf, 1.0))
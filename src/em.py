@@ -1,41 +1,259 @@
 import numpy as np
 import time
 
-from src.gibbs import run_gibbs, get_expected_image
+from src.bp import run_bp
+from src.diagnostics import GibbsDiagnostics, reachable_min_iter
+from src.gibbs import run_gibbs, get_expected_image, ColorCounts
+from src.graphcut import map_graphcut
+from src.icm import run_icm
+from src.instrument import timed, Timings
+from src.mean_field import run_mean_field
 from src.potentials import calculate_J, calculate_mu
+from src.pyramid import build_pyramid, upsample
+from src.utils import get_rng
+
+INFERENCE = ["gibbs", "mean_field", "icm", "anneal", "graphcut", "bp", "bp_max"]
 
 
 def run_em(noisy_arr, n_colors=2, n_em_iters=10, n_gibbs_iters=10, burnin=5,
-       sample_every=2, beta=1, smoothing=1, mu=None, J=None):
+       sample_every=2, beta=1, smoothing=1, mu=None, J=None, keep="thinned",
+       schedule="sequential", share_params=True, inference="gibbs",
+       n_inference_iters=50, inference_tol=1e-4, stop_when_converged=False,
+       param_tol=None, pixel_tol=None, n_levels=1, coarse_em_iters=None,
+       rng=None, callback=None):
     """
 
     Args:
-        noisy_arr: the original noisy array to include
+        noisy_arr: the original noisy array to include, or a 3D
+            `(N, height, width)` stack of noisy images to denoise together
+        n_colors: the number of colors
+        n_em_iters: the number of EM iterations
+        n_gibbs_iters, burnin, sample_every: how long to run each E-step's
+            Gibbs chain and which of its samples go into the mode image
+        beta, J, mu: hyperparameters for the potential functions; J and mu
+            are the starting values and are re-estimated every iteration
+        smoothing: passed to `calculate_J` and `calculate_mu`
+        keep: retention policy for the Gibbs samples (see `run_gibbs`).
+            Only the thinned samples are needed for the E-step; use "all"
+            to keep every iteration in `extra_info["gibbs_samples"]`. With
+            "last", the E-step image is the chain's final state; with
+            "none", no samples are kept and the mode comes from a
+            `ColorCounts` (which keeps the fixed `burnin` even with
+            `stop_when_converged`).
+        schedule: the Gibbs sweep order (see `run_gibbs`); "checkerboard"
+            is much faster, especially for stacks of images
+        share_params: for a stack of images, estimate one J and mu from the
+            whole stack (True) or one per image (False)
+        inference: how to run the E-step. "gibbs" takes the mode of a Gibbs
+            chain; "mean_field" takes the argmax of the marginals from
+            `run_mean_field`, which is deterministic and much faster. The
+            mean-field marginals are warm-started from the previous EM
+            iteration and end up in `extra_info["marginals"]`. "icm" and
+            "anneal" take the MAP estimate from `run_icm`, without and with
+            simulated annealing; ICM is warm-started from the previous EM
+            image. "graphcut" takes the exact MAP estimate from
+            `map_graphcut` (two colors only, with submodular J). "bp" and
+            "bp_max" take the argmax of the beliefs from sum-product and
+            max-product `run_bp`; the messages are warm-started from the
+            previous EM iteration and the beliefs end up in
+            `extra_info["beliefs"]`.
+        n_inference_iters, inference_tol: the maximum number of sweeps and
+            the convergence tolerance for mean-field inference and BP (ICM
+            stops once a sweep changes nothing)
+        stop_when_converged: end each Gibbs E-step once its chain looks
+            converged (see `GibbsDiagnostics`), with `n_gibbs_iters` as a
+            cap and the first half of the chain as burn-in. Split-R-hat needs
+            at least 8 sweeps, so give a cap well above that. Each E-step's
+            diagnostics go in `extra_info["diagnostics"]`.
+        param_tol: stop early once the relative change (in Frobenius norm)
+            of both J and mu in an iteration is below `param_tol`
+        pixel_tol: stop early once the fraction of pixels whose color
+            changed in the mode image in an iteration is at most `pixel_tol`.
+            If both tolerances are given, both must be met; with neither,
+            all `n_em_iters` iterations run.
+        n_levels: with more than one, start coarse to fine: run EM first on
+            an image shrunk by majority vote (see `src.pyramid`), itself
+            started from `n_levels - 1` coarser levels, and begin at full
+            resolution with its J and mu and its last image upsampled. The
+            Gibbs chains and ICM then start from that image, and each later
+            E-step from the previous one's image, rather than from the noisy
+            image; mean-field starts from the upsampled marginals. Levels
+            stop before either side drops below 8 pixels. The coarse run's
+            `extra_info` is kept in `extra_info["coarse"]`.
+        coarse_em_iters: the number of EM iterations at each coarse level;
+            defaults to `n_em_iters`
+        rng: the random stream for the Gibbs E-steps (see `run_gibbs`)
+        callback: optional function called with an event dictionary (see
+            `src.instrument.timed`) after every Gibbs sweep ("sweep"), E-step
+            ("e_step"), M-step ("m_step") and `calculate_J`/`calculate_mu`
+            call. A per-phase summary of the same events is always stored in
+            `extra_info["timings"]`.
 
     Returns:
-        samples: a list of `n_em_iters` 2D arrays, where each array represents
-                 the image after one iteration of the EM algorithm.
+        samples: a list of up to `n_em_iters` 2D arrays, where each array
+                 represents the image after one iteration of the EM algorithm.
         extra_info: a dictionary you can use for debugging and experimentation.
                     You need to keep the gibbs_samples, J, mu arguments as they
                     are for tests/test_em, but you can add other information.
+                    `extra_info["history"]` holds per-iteration lists of J,
+                    mu, the relative change in each (`J_change`,
+                    `mu_change`), the number of pixels that changed in the
+                    mode image (`n_changed`; the first compares to the
+                    noisy image) and the seconds since the start (`time`).
     """
 
+    assert inference in INFERENCE, f"inference must be one of {INFERENCE}"
     start = time.time()
+    rng = get_rng(rng)
+    timings = Timings(forward=callback)
     extra_info = {}
     em_samples = []
     arr = noisy_arr.copy()
+    marginals = None
+    bp_info = {"messages": None}
+    diagnostics = []
+    history = {"J": [], "mu": [], "J_change": [], "mu_change": [],
+               "n_changed": [], "time": []}
+    prev_image = noisy_arr
+    start_image = None
+
+    levels = build_pyramid(noisy_arr, n_colors, n_levels=2 if n_levels > 1 else 1)
+    if len(levels) > 1:
+        with timed(timings, "coarse_level", levels[1].size):
+            coarse_samples, coarse_info = run_em(
+                levels[1], n_colors=n_colors,
+                n_em_iters=coarse_em_iters or n_em_iters,
+                n_gibbs_iters=n_gibbs_iters, burnin=burnin,
+                sample_every=sample_every, beta=beta, smoothing=smoothing,
+                mu=mu, J=J, keep=keep, schedule=schedule,
+                share_params=share_params, inference=inference,
+                n_inference_iters=n_inference_iters,
+                inference_tol=inference_tol,
+                stop_when_converged=stop_when_converged, param_tol=param_tol,
+                pixel_tol=pixel_tol, n_levels=n_levels - 1,
+                coarse_em_iters=coarse_em_iters, rng=rng, callback=callback)
+        J, mu = coarse_info["J"], coarse_info["mu"]
+        start_image = upsample(coarse_samples[-1], noisy_arr.shape[-2:])
+        if inference == "mean_field":
+            marginals = upsample(coarse_info["marginals"], noisy_arr.shape[-2:],
+                                 axes=(-3, -2))
+        extra_info["coarse"] = coarse_info
 
     for i in range(n_em_iters):
 
-        gibbs_samples = run_gibbs(arr, n_iter=n_gibbs_iters, n_colors=n_colors, J=J,
-                                  mu=mu, beta=beta)
+        with timed(timings, "e_step", iteration=i) as e_step:
+            if inference == "mean_field":
+                mf_schedule = "checkerboard" if schedule == "checkerboard" else "parallel"
+                marginals, mf_info = run_mean_field(
+                    arr, n_colors=n_colors, beta=beta, J=J, mu=mu,
+                    n_iter=n_inference_iters, tol=inference_tol,
+                    schedule=mf_schedule, init=marginals)
+                image = np.argmax(marginals, axis=-1).astype(np.uint8)
+                e_step["pixels"] = mf_info["n_iter"] * arr.size
+            elif inference in ["icm", "anneal"]:
+                image, icm_info = run_icm(
+                    arr, n_colors=n_colors, beta=beta, J=J, mu=mu,
+                    n_iter=n_inference_iters, anneal=inference == "anneal",
+                    init=start_image, rng=rng)
+                e_step["pixels"] = icm_info["n_iter"] * arr.size
+            elif inference in ["bp", "bp_max"]:
+                bp_schedule = "checkerboard" if schedule == "checkerboard" else "parallel"
+                image, beliefs, bp_info = run_bp(
+                    arr, n_colors=n_colors, beta=beta, J=J, mu=mu,
+                    n_iter=n_inference_iters, tol=inference_tol,
+                    mode="max" if inference == "bp_max" else "sum",
+                    schedule=bp_schedule, init=bp_info["messages"])
+                e_step["pixels"] = bp_info["n_iter"] * arr.size
+            elif inference == "graphcut":
+                assert n_colors == 2, "graphcut inference needs two colors"
+                image = map_graphcut(arr, J=J, mu=mu, beta=beta)
+                e_step["pixels"] = arr.size
+            else:
+                if stop_when_converged:
+                    diagnostics.append(GibbsDiagnostics(
+                        min_iter=reachable_min_iter(n_gibbs_iters)))
+                n_sweeps = len(timings.events)
+                counts = None
+                if keep == "none":
+                    counts = ColorCounts(arr.shape, n_colors=n_colors, burnin=burnin,
+                                         sample_every=sample_every)
+                gibbs_samples = run_gibbs(arr, n_iter=n_gibbs_iters, n_colors=n_colors,
+                                          J=J, mu=mu, beta=beta, keep=keep, counts=counts,
+                                          burnin=burnin, sample_every=sample_every,
+                                          schedule=schedule,
+                                          diagnostics=diagnostics[-1] if diagnostics else None,
+                                          stop_when_converged=stop_when_converged,
+                                          init=start_image, rng=rng,
+                                          callback=timings)
+                if keep == "none":
+                    image = counts.mode()
+                elif keep in ["thinned", "last"]:
+                    image = get_expected_image(gibbs_samples, burnin=0)
+                else:
+                    image = get_expected_image(
+                        gibbs_samples,
+                        burnin=diagnostics[-1].burnin if diagnostics else burnin,
+                        sample_every=sample_every)
+                e_step["pixels"] = (len(timings.events) - n_sweeps) * arr.size
+        em_samples.append(image)
+        if inference in ["icm", "anneal"] or start_image is not None:
+            start_image = image
+
+        per_image = not share_params
+        prev_J, prev_mu = J, mu
+        with timed(timings, "m_step", image.size, iteration=i):
+            with timed(timings, "calculate_J", image.size, iteration=i):
+                J = calculate_J(image, n_colors=n_colors, smoothing=smoothing,
+                                per_image=per_image)
+            with timed(timings, "calculate_mu", image.size, iteration=i):
+                mu = calculate_mu(noisy_arr, image, n_colors=n_colors,
+                                  smoothing=smoothing, per_image=per_image)
+
+        n_changed = int(np.sum(image != prev_image))
+        prev_image = image
+        history["J"].append(J)
+        history["mu"].append(mu)
+        history["J_change"].append(_relative_change(J, prev_J))
+        history["mu_change"].append(_relative_change(mu, prev_mu))
+        history["n_changed"].append(n_changed)
+        history["time"].append(time.time() - start)
 
-        raise NotImplementedError
+        converged = []
+        if param_tol is not None:
+            converged.append(max(history["J_change"][-1],
+                                 history["mu_change"][-1]) < param_tol)
+        if pixel_tol is not None:
+            converged.append(n_changed <= pixel_tol * image.size)
+        if converged and all(converged):
+            break
 
     # NOTE: Keep this code here for `tests/test_em.py`
-    extra_info["gibbs_samples"] = gibbs_samples
+    if inference == "gibbs":
+        extra_info["gibbs_samples"] = gibbs_samples
+    elif inference == "mean_field":
+        extra_info["marginals"] = marginals
+    elif inference in ["bp", "bp_max"]:
+        extra_info["beliefs"] = beliefs
+    if diagnostics:
+        extra_info["diagnostics"] = diagnostics
     extra_info["J"] = J
     extra_info["mu"] = mu
+    extra_info["history"] = history
+    extra_info["timings"] = timings.summary()
     runtime = (time.time() - start) / 60
-    print(f"{n_em_iters} EM iters with {n_gibbs_iters} Gibbs iters took {runtime:.2f} min")
+    n_run = len(em_samples)
+    if inference == "gibbs":
+        print(f"{n_run} EM iters with {n_gibbs_iters} Gibbs iters took {runtime:.2f} min")
+    else:
+        print(f"{n_run} EM iters with {inference} inference took {runtime:.2f} min")
     return em_samples, extra_info
+
+
+def _relative_change(new, old):
+    """
+    The Frobenius norm of `new - old` relative to that of `old`, or infinity
+        if there is no previous value (the default parameters were used).
+    """
+    if old is None:
+        return np.inf
+    return np.linalg.norm(new - old) / max(np.linalg.norm(old), 1e-12)
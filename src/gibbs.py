@@ -1,16 +1,33 @@
+import collections.abc
 import itertools
 import numpy as np
 from scipy.stats import mode
 
-from src.potentials import ising_potential, potts_potential
+from src.cluster import swendsen_wang_sweep
+from src.diagnostics import GibbsDiagnostics, reachable_min_iter
+from src.instrument import timed
+from src.parallel import run_chains
+from src.potentials import ising_potential, potts_potential, potts_conditionals
+from src.potentials import sample_colors, conditional_table, neighbor_codes
+from src.potentials import check_params, conditionals_from_counts, MAX_TABLE_ROWS
+from src.utils import get_neighborhood, get_rng
 
+SCHEDULES = ["sequential", "checkerboard", "swendsen_wang"]
+KEEP = ["all", "thinned", "last", "none"]
 
-def run_gibbs(orig_arr, n_iter, n_colors=2, beta=1, J=None, mu=None):
+
+def run_gibbs(orig_arr, n_iter, n_colors=2, beta=1, J=None, mu=None,
+              schedule="sequential", n_chains=1, n_workers=None, counts=None,
+              keep="all", burnin=0, sample_every=1, diagnostics=None,
+              stop_when_converged=False, pack=False, init=None, rng=None,
+              callback=None):
     """
     Run the Gibbs Sampling algorithm on the image to get estimates of p(z | x)
 
     Args:
-        orig_arr: the original image array
+        orig_arr: the original image array, or a 3D `(N, height, width)` stack
+            of images that are all sampled together. Each sample is then
+            a stack of the same shape.
         n_iter: the number of iterations to run
             This is not the total number of conditional probabilities to
             calculate!  In each iteration, you should sample N new points,
@@ -20,16 +37,398 @@ def run_gibbs(orig_arr, n_iter, n_colors=2, beta=1, J=None, mu=None):
         n_colors: The number of colors. If n == 2, use `ising_potential`.
             Otherwise, using `potts_potential`.
         beta, J, mu: hyperparameters for the potential function. Pass these to the
-            potential functions.
+            potential functions. For a stack of N images, J and mu can have
+            shape `(N, n_colors, n_colors)` to give each image its own.
+        schedule: "sequential" visits pixels one at a time in raster order.
+            "checkerboard" splits the grid into two interleaved halves, like
+            the squares of a checkerboard. Because each pixel's four
+            neighbors all lie on the other half, every pixel in one half is
+            conditionally independent of the rest of its half, so the whole
+            half can be resampled at once with the same stationary
+            distribution. It is much faster, especially for stacks of
+            images, where one checkerboard step covers the whole stack in a
+            single NumPy operation. "sequential" still visits the pixel
+            positions one at a time, but each step updates that pixel in
+            every image of the stack at once.
+            "swendsen_wang" replaces each iteration with a Swendsen-Wang
+            cluster move (see `src.cluster.swendsen_wang_sweep`), which
+            can recolor whole regions at once and mixes much faster than
+            single-pixel updates at high `beta`.
+        n_chains: the number of independent chains to run. If more than one,
+            the chains run in parallel via `src.parallel.run_chains`, each
+            with its own random stream.
+        n_workers: the number of worker processes for `n_chains > 1`;
+            defaults to one per chain, up to the number of CPUs.
+        counts: optional `ColorCounts` that is updated in place with the
+            state after every iteration, so the mode image and per-pixel
+            marginals can be read from it without keeping the samples.
+            With `n_chains > 1`, every chain's counts are added to it.
+        keep: which samples to return. "all" keeps a copy of every
+            iteration; "thinned" keeps only `samples[burnin::sample_every]`;
+            "last" keeps only the final state; "none" keeps nothing, which
+            is useful together with `counts`.
+        burnin, sample_every: which samples `keep="thinned"` retains
+        diagnostics: optional `GibbsDiagnostics` that records the energy and
+            the fraction of flipped pixels after every sweep
+        stop_when_converged: stop as soon as `diagnostics` (created if not
+            given, with a `min_iter` the cap allows) judges the chain
+            converged, treating `n_iter` as a cap; `n_iter=None` means no
+            cap. The first half of the sweeps is then the burn-in: it is
+            stored in `diagnostics.burnin` and replaces the `burnin` argument
+            for `keep="thinned"`. `counts` still uses its own burnin. With
+            `n_chains > 1`, each chain stops on its own diagnostics (see
+            `GibbsDiagnostics`).
+        pack: for binary images, store the kept samples bit-packed in a
+            `PackedSamples`, which uses one bit per pixel instead of a byte
+        init: optional starting state of the chain, of the same shape as
+            `orig_arr` (e.g. an upsampled coarse estimate from
+            `src.pyramid`); defaults to `orig_arr` itself
+        rng: a `np.random.Generator`, int seed or `np.random.SeedSequence`
+            (see `src.utils.get_rng`); by default, seeded from the global
+            `np.random` state. With `n_chains > 1`, each chain gets its own
+            stream spawned from it, so results don't depend on `n_workers`.
+        callback: optional function called with an event dictionary after
+            every sweep (see `src.instrument.timed`); `src.instrument.Timings`
+            collects them. Only supported with `n_chains == 1`.
 
     Returns:
-        samples: a list of arrays, where each array represents the pixels of an
-            image after one iteration of the algorithm.
+        samples: a list of uint8 arrays, where each array represents the pixels
+            of an image after one iteration of the algorithm (a `PackedSamples`
+            if `pack`). If `n_chains > 1`, a list with one such list per chain.
+    """
+    assert keep in KEEP, f"keep must be one of {KEEP}"
+    assert not pack or n_colors == 2, "Only binary samples can be packed"
+    assert n_chains == 1 or callback is None, "Callbacks only run in this process"
+    if stop_when_converged and diagnostics is None:
+        diagnostics = GibbsDiagnostics(min_iter=reachable_min_iter(n_iter))
+    if n_chains > 1:
+        return run_chains(orig_arr, n_iter, n_chains=n_chains,
+                          n_workers=n_workers, n_colors=n_colors, beta=beta,
+                          J=J, mu=mu, schedule=schedule, counts=counts,
+                          keep=keep, burnin=burnin, sample_every=sample_every,
+                          diagnostics=diagnostics,
+                          stop_when_converged=stop_when_converged, pack=pack,
+                          init=init, seed=rng)
+
+    samples = PackedSamples(orig_arr.shape) if pack else []
+    # With an automatic burn-in, `keep="thinned"` can't thin until the end,
+    #   so track which sweep each kept sample came from
+    sample_idxs = []
+    arr = None
+    if diagnostics is not None:
+        prev_arr = (orig_arr if init is None else init).copy()
+    states = iter_gibbs(orig_arr, n_iter, n_colors=n_colors, beta=beta, J=J,
+                        mu=mu, schedule=schedule, init=init, rng=rng,
+                        callback=callback)
+    for t, arr in enumerate(states):
+        if counts is not None:
+            counts.add(arr)
+        if diagnostics is not None:
+            diagnostics.update(arr, prev_arr, orig_arr, J=J, mu=mu,
+                               n_colors=n_colors)
+            prev_arr[...] = arr
+
+        if stop_when_converged and keep == "thinned":
+            samples.append(arr.copy())
+            sample_idxs.append(t)
+            # The burn-in will be at least half of the sweeps run so far
+            while sample_idxs[0] < (t + 1) // 2:
+                samples.pop(0)
+                sample_idxs.pop(0)
+        elif keep == "all" or (keep == "thinned" and t >= burnin
+                               and (t - burnin) % sample_every == 0):
+            samples.append(arr.copy())
+
+        if stop_when_converged and diagnostics.check():
+            break
+
+    if stop_when_converged:
+        if diagnostics.burnin is None:
+            diagnostics.burnin = len(diagnostics.energy) // 2
+        if keep == "thinned":
+            for i in reversed(range(len(samples))):
+                t = sample_idxs[i]
+                if t < diagnostics.burnin or (t - diagnostics.burnin) % sample_every:
+                    del samples[i]
+    if keep == "last" and arr is not None:
+        samples.append(arr.copy())
+    return samples
+
+
+def iter_gibbs(orig_arr, n_iter=None, n_colors=2, beta=1, J=None, mu=None,
+               schedule="sequential", init=None, rng=None, callback=None):
+    """
+    Generator form of `run_gibbs`: yield the state after each iteration.
+
+    The same array is updated in place and yielded every time, so nothing is
+        copied unless the caller copies it. Call `.copy()` on anything you
+        want to keep past the next iteration.
+
+    Args:
+        orig_arr: the original image array
+        n_iter: the number of iterations to run, or None to run until the
+            caller stops iterating
+        n_colors, beta, J, mu, schedule, init, rng, callback: as in `run_gibbs`.
+            The callback's "sweep" events carry the `iteration`. For a stack
+            of N images, each image draws from its own stream spawned from
+            `rng`, so image n is sampled exactly as it would be on its own
+            with `rng.spawn(N)[n]`.
+
+    Each sweep draws the uniforms for all of its pixels in one call.
+
+    Yields:
+        arr: the current state of the chain
+    """
+    assert schedule in SCHEDULES, f"schedule must be one of {SCHEDULES}"
+    assert orig_arr.ndim in (2, 3)
+    assert n_colors <= 256
+    # Don't modify `orig_arr`! The chain's state is kept as uint8.
+    arr = (orig_arr if init is None else init).astype(np.uint8)
+    assert arr.shape == orig_arr.shape
+    rng = get_rng(rng)
+    image_rngs = rng.spawn(arr.shape[0]) if arr.ndim == 3 else [rng]
+
+    neighborhood = halves = None
+    if schedule == "checkerboard":
+        neighborhood = get_neighborhood(arr.shape[-2:])
+        ii, jj = np.indices(arr.shape[-2:])
+        halves = [(ii + jj) % 2 == 0, (ii + jj) % 2 == 1]
+
+    iterations = itertools.count() if n_iter is None else range(n_iter)
+    for t in iterations:
+        with timed(callback, "sweep", arr.size, iteration=t):
+            _sweep(arr, orig_arr, n_colors, beta, J, mu, schedule, image_rngs,
+                   neighborhood, halves)
+        yield arr
+
+
+def _sweep(arr, orig_arr, n_colors, beta, J, mu, schedule, image_rngs,
+           neighborhood, halves):
+    """
+    Run one iteration of `iter_gibbs`, updating `arr` in place.
+    """
+    if schedule == "swendsen_wang":
+        images = [arr] if arr.ndim == 2 else arr
+        origs = [orig_arr] if arr.ndim == 2 else orig_arr
+        for n, image_rng in enumerate(image_rngs):
+            swendsen_wang_sweep(images[n], origs[n], n_colors=n_colors,
+                                beta=beta, J=_image_params(J, n),
+                                mu=_image_params(mu, n), rng=image_rng)
+        return
+
+    u = np.stack([image_rng.random(arr.shape[-2:]) for image_rng in image_rngs])
+    u = u.reshape(arr.shape)
+    if schedule == "checkerboard":
+        for half in halves:
+            probs = potts_conditionals(arr, orig_arr, beta=beta, J=J,
+                                       mu=mu, n_colors=n_colors, mask=half,
+                                       neighborhood=neighborhood)
+            arr[..., half] = sample_colors(probs, u=u[..., half])
+    else:
+        _sequential_sweep(arr, orig_arr, n_colors, beta, J, mu, u)
+
+
+def _sequential_sweep(arr, orig_arr, n_colors, beta, J, mu, u):
+    """
+    Resample every pixel of `arr` in place, one at a time in raster order,
+        inverting each conditional's CDF against the uniform in `u`. For a
+        stack, each pixel position is resampled in every image at once, so
+        the Python loop is no longer than for a single image.
+    """
+    cdf = _conditional_cdfs(J, mu, beta, n_colors, arr.shape[:-2])
+    if cdf is None and arr.ndim == 2:
+        for i, j in itertools.product(*map(range, arr.shape)):
+            if n_colors == 2:
+                probs = ising_potential(
+                    arr, i, j, orig_arr[i, j], beta=beta, J=J, mu=mu)
+            else:
+                probs = potts_potential(
+                    arr, i, j, orig_arr[i, j], beta=beta, J=J, mu=mu,
+                    n_colors=n_colors)
+            arr[i, j] = sample_colors(probs, u=u[i, j])
+        return
+
+    neighborhood = get_neighborhood(arr.shape[-2:])
+    index, valid = neighborhood.index, neighborhood.valid
+    # One row per image; `arr` is the sampler's own contiguous state
+    flat = arr.reshape(-1, index.shape[0])
+    assert np.shares_memory(flat, arr)
+    orig_flat, u_flat = orig_arr.reshape(flat.shape), u.reshape(flat.shape)
+
+    if cdf is None:
+        # Too many colors for tables
+        J, mu = check_params(J, mu, n_colors, batch_shape=arr.shape[:1])
+        eye = np.eye(n_colors)
+        for p in range(flat.shape[1]):
+            counts = valid[p] @ eye[flat[:, index[p]]]
+            probs = conditionals_from_counts(counts[:, None], orig_flat[:, p, None],
+                                             beta, J, mu)[:, 0]
+            flat[:, p] = sample_colors(probs, u=u_flat[:, p])
+        return
+
+    # Same conditionals as the potential functions, read from the tables.
+    #   The code of a single neighbor of each color; codes add up.
+    powers = neighbor_codes(np.eye(n_colors, dtype=np.intp))
+    if arr.ndim == 2:
+        # Scalar steps are much cheaper than length-one vector ones
+        cdf, flat, orig_flat, u_flat = cdf[0], flat[0], orig_flat[0], u_flat[0]
+        for p in range(flat.size):
+            code = powers[flat[index[p]]] @ valid[p]
+            color = np.count_nonzero(u_flat[p] > cdf[code, orig_flat[p]])
+            flat[p] = min(color, n_colors - 1)
+        return
+
+    # Shared tables are stored once and picked by every image
+    table_idx = np.arange(flat.shape[0]) if cdf.shape[0] > 1 else np.zeros(flat.shape[0], int)
+    for p in range(flat.shape[1]):
+        code = powers[flat[:, index[p]]] @ valid[p]
+        bounds = cdf[table_idx, code, orig_flat[:, p]]
+        color = np.count_nonzero(u_flat[:, p, None] > bounds, axis=-1)
+        flat[:, p] = np.minimum(color, n_colors - 1)
+
+
+def _conditional_cdfs(J, mu, beta, n_colors, batch_shape):
+    """
+    The cumulative sums of the `conditional_table` of each image, stacked
+        along a first axis of length one when J and mu are shared, or None if
+        the tables would be too large.
     """
-    # Don't modify `orig_arr`!
-    arr = orig_arr.copy()
+    if not any(x is not None and x.ndim == 3 for x in [J, mu]):
+        table = conditional_table(J, mu, beta, n_colors)
+        return None if table is None else np.cumsum(table, axis=-1)[None]
 
-    raise NotImplementedError
+    n_images = batch_shape[0]
+    if n_images * (4 + 1) ** n_colors > MAX_TABLE_ROWS:
+        return None
+    tables = [conditional_table(_image_params(J, n), _image_params(mu, n), beta, n_colors)
+              for n in range(n_images)]
+    return np.cumsum(np.stack(tables), axis=-1)
+
+
+def _image_params(params, n):
+    """
+    Pick image n's J or mu out of a per-image stack; shared ones pass through.
+    """
+    if params is not None and params.ndim == 3:
+        return params[n]
+    return params
+
+
+class ColorCounts:
+    """
+    Running per-pixel histogram of the colors sampled by `run_gibbs`.
+
+    Memory is `O(height * width * n_colors)` no matter how many samples are
+        added, so long chains don't need to keep every sample around just to
+        compute `get_expected_image`.
+
+    Args:
+        shape: the shape of each sample
+        n_colors: the number of colors
+        burnin: how many of the first samples passed to `add` to ignore
+        sample_every: after burnin, count one sample every so often
+    """
+
+    def __init__(self, shape, n_colors=2, burnin=0, sample_every=1):
+        assert 0 <= burnin
+        assert (type(sample_every) == int) and (sample_every >= 1)
+        self.shape = tuple(shape)
+        self.n_colors = n_colors
+        self.burnin = burnin
+        self.sample_every = sample_every
+        self.counts = np.zeros(self.shape + (n_colors,), dtype=np.int32)
+        self.n_seen = 0
+        self.n_kept = 0
+
+        # Flat offset of each pixel's first color in `counts`
+        self._offsets = np.arange(np.prod(self.shape)) * n_colors
+
+    def add(self, arr):
+        """
+        Offer one sample; it is counted unless burnin or thinning skip it.
+        """
+        assert arr.shape == self.shape
+        t = self.n_seen
+        self.n_seen += 1
+        if t < self.burnin or (t - self.burnin) % self.sample_every != 0:
+            return
+        self.counts.reshape(-1)[self._offsets + arr.reshape(-1)] += 1
+        self.n_kept += 1
+
+    def merge(self, other):
+        """
+        Add in the counts from another accumulator, e.g. another chain.
+        """
+        assert self.counts.shape == other.counts.shape
+        self.counts += other.counts
+        self.n_seen += other.n_seen
+        self.n_kept += other.n_kept
+
+    def empty_copy(self):
+        """
+        A fresh accumulator with the same settings and no counts.
+        """
+        return ColorCounts(self.shape, self.n_colors, self.burnin,
+                           self.sample_every)
+
+    def mode(self):
+        """
+        The most frequently sampled color of each pixel, breaking ties
+            toward the smaller color index like `scipy.stats.mode`.
+        """
+        assert self.n_kept > 0, "No samples have been counted yet"
+        return np.argmax(self.counts, axis=-1).astype(np.uint8)
+
+    def marginals(self):
+        """
+        The fraction of counted samples in which each pixel took each color,
+            as an array of shape `shape + (n_colors,)`.
+        """
+        assert self.n_kept > 0, "No samples have been counted yet"
+        return self.counts / self.n_kept
+
+
+class PackedSamples(collections.abc.Sequence):
+    """
+    A list of binary samples stored with `np.packbits`, one bit per pixel.
+
+    Indexing unpacks: an integer index returns one uint8 sample, and a slice
+        returns a list of them, so `samples[burnin::sample_every]` and
+        `get_expected_image` work as they do on a plain list.
+
+    Args:
+        shape: the shape of each sample
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self._packed = []
+
+    def append(self, arr):
+        assert arr.shape == self.shape
+        self._packed.append(np.packbits(arr, axis=None))
+
+    def pop(self, index=-1):
+        return self._unpack(self._packed.pop(index))
+
+    def __delitem__(self, index):
+        del self._packed[index]
+
+    def __len__(self):
+        return len(self._packed)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._unpack(x) for x in self._packed[index]]
+        return self._unpack(self._packed[index])
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self._packed)
+
+    def _unpack(self, packed):
+        n_pixels = int(np.prod(self.shape))
+        return np.unpackbits(packed, count=n_pixels).reshape(self.shape)
 
 
 def get_expected_image(samples, burnin=5, sample_every=1):
@@ -39,7 +438,12 @@ def get_expected_image(samples, burnin=5, sample_every=1):
         image of the corresponding size.
 
     Args:
-        samples: a list of 2D arrays representing the outputs of `run_gibbs`
+        samples: a list (or `PackedSamples`) of 2D arrays representing the
+            outputs of `run_gibbs`, or a list of such lists (one per chain) from `run_gibbs` with
+            `n_chains > 1`. Chains are pooled after dropping each chain's
+            burnin and thinning it. Can also be a `ColorCounts` that was
+            passed to `run_gibbs`, which has already applied its own
+            burnin and thinning, so those arguments are ignored.
         burnin: how many samples to ignore from the start of the `samples` list
         sample_every: after burnin, go through `samples` and take one sample
                       every so often
@@ -51,12 +455,21 @@ def get_expected_image(samples, burnin=5, sample_every=1):
     Returns:
         arr: a 2D image arrary of the same shape as each image in `samples`
              that takes the mode (e.g., scipy.stats.mode) value of the
-             included samples.
+             included samples. If the samples are `(N, height, width)`
+             stacks from a batched `run_gibbs`, a stack of N mode images.
 
     """
-    assert 0 <= burnin
-    assert burnin < len(samples)
-    assert (type(sample_every) == int) and (sample_every >= 1)
-    assert np.all([samples[0].size == x.size for x in samples])
+    if isinstance(samples, ColorCounts):
+        return samples.mode()
+
+    chains = samples
+    if not isinstance(samples[0], (list, tuple, PackedSamples)):
+        chains = [samples]
+    for chain in chains:
+        assert 0 <= burnin
+        assert burnin < len(chain)
+        assert (type(sample_every) == int) and (sample_every >= 1)
+        assert np.all([chains[0][0].size == x.size for x in chain])
 
-    raise NotImplementedError
+    kept = [x for chain in chains for x in chain[burnin::sample_every]]
+    return mode(np.stack(kept), axis=0).mode
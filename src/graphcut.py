@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, maximum_flow
+
+from src.potentials import check_params
+from src.utils import grid_edges
+
+# Capacities are scaled so the total of all of them is at most this, which
+#   keeps every flow within scipy's int32 capacities
+MAX_TOTAL_CAPACITY = 2 ** 30
+
+
+def map_graphcut(noisy_arr, J=None, mu=None, beta=1):
+    """
+    Find the exact MAP estimate of a binary image with a single s-t min cut.
+
+    The model is the one `ising_potential` samples from: p(Z | X) is
+        proportional to exp(-beta * energy) with the energy of
+        `src.potentials.image_energy`, that is, minus the sum of the
+        symmetrized J over neighboring pairs and of mu[z, x] over pixels.
+        Each pixel becomes a node; pixels left on the source side of the
+        minimum cut take color 0 and the rest take color 1.
+
+    Min cuts can only minimize submodular energies, which here means
+        `J[0, 0] + J[1, 1] >= J[0, 1] + J[1, 0]`: neighbors must prefer to
+        agree. `default_J` and the J that `calculate_J` estimates from
+        smooth images both are.
+
+    `scipy.sparse.csgraph.maximum_flow` needs integer capacities, so the
+        energies are scaled (see `MAX_TOTAL_CAPACITY`) and rounded. On very
+        large images, labelings within that rounding of the optimum may be
+        returned instead.
+
+    Args:
+        noisy_arr: the observed binary image, or a 3D stack of images
+        J, mu: `(2, 2)` hyperparameters, as in `ising_potential`. For a
+            stack, `(N, 2, 2)` per-image J and mu are also accepted.
+        beta: the inverse temperature; it scales the energy, so it does not
+            change the MAP labeling
+
+    Returns:
+        a uint8 array of the same shape as `noisy_arr`
+
+    Raises:
+        ValueError: if J is not submodular
+    """
+    assert np.all((noisy_arr == 0) | (noisy_arr == 1))
+    assert beta > 0
+    J, mu = check_params(J, mu, 2, batch_shape=noisy_arr.shape[:-2])
+    if noisy_arr.ndim == 3:
+        return np.stack([
+            map_graphcut(noisy_arr[n], J[n] if J.ndim == 3 else J,
+                         mu[n] if mu.ndim == 3 else mu, beta)
+            for n in range(noisy_arr.shape[0])])
+
+    J = (J + J.T) / 2
+    if J[0, 0] + J[1, 1] < J[0, 1] + J[1, 0]:
+        raise ValueError(
+            "map_graphcut needs a submodular J with J[0, 0] + J[1, 1] >= "
+            f"J[0, 1] + J[1, 0], but got J = {J.tolist()}")
+
+    # Pairwise energy theta(a, b) = -beta * J[a, b] of an edge (p, q) splits
+    #   into theta(0, 0), a cost of theta(1, 0) - theta(0, 0) for p = 1, a
+    #   cost of theta(1, 1) - theta(1, 0) for q = 1, and a nonnegative cost
+    #   for p = 0, q = 1 that becomes the capacity of the edge p -> q.
+    theta = -beta * J
+    first, second = grid_edges(noisy_arr.shape)
+    n_pixels = noisy_arr.size
+    orig = noisy_arr.reshape(-1).astype(np.intp)
+
+    # Extra cost of color 1 over color 0 for each pixel
+    unary = -beta * (mu[1, orig] - mu[0, orig])
+    unary = (unary
+             + np.bincount(first, minlength=n_pixels) * (theta[1, 0] - theta[0, 0])
+             + np.bincount(second, minlength=n_pixels) * (theta[1, 1] - theta[1, 0]))
+    pairwise = theta[0, 1] + theta[1, 0] - theta[0, 0] - theta[1, 1]
+
+    # Nodes are the pixels, then the source, then the sink
+    source, sink = n_pixels, n_pixels + 1
+    pixels = np.arange(n_pixels)
+    tails = np.concatenate([first, np.where(unary > 0, source, pixels)])
+    heads = np.concatenate([second, np.where(unary > 0, pixels, sink)])
+    capacity = np.concatenate([np.full(first.shape, pairwise), np.abs(unary)])
+
+    scale = MAX_TOTAL_CAPACITY / max(capacity.sum(), 1e-12)
+    capacity = np.round(capacity * scale).astype(np.int32)
+    keep = capacity > 0
+    graph = csr_matrix(coo_matrix((capacity[keep], (tails[keep], heads[keep])),
+                                  shape=(n_pixels + 2, n_pixels + 2)))
+
+    flow = maximum_flow(graph, source, sink).flow
+    residual = (graph - flow).tocsr()
+    residual.data = (residual.data > 0).astype(np.int8)
+    residual.eliminate_zeros()
+    on_source_side = breadth_first_order(residual, source, directed=True,
+                                         return_predecessors=False)
+
+    labels = np.ones(n_pixels + 2, dtype=np.uint8)
+    labels[on_source_side] = 0
+    return labels[:n_pixels].reshape(noisy_arr.shape)
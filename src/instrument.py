@@ -0,0 +1,120 @@
+import contextlib
+import time
+import tracemalloc
+
+# Peak traced memory seen so far by each phase that is still running,
+#   innermost last; see `timed`
+_open_peaks = []
+# The largest tracemalloc peak that `timed` has reset; see `peak_traced_memory`
+_reset_peak = 0
+
+
+def peak_traced_memory():
+    """
+    The peak traced memory since tracemalloc started or `clear_peak` was
+        last called. `timed` resets tracemalloc's own peak to measure each
+        phase, so use this instead of `tracemalloc.get_traced_memory()[1]`.
+
+    Returns:
+        bytes, or None if tracemalloc isn't tracing
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    return max(_reset_peak, tracemalloc.get_traced_memory()[1])
+
+
+def clear_peak():
+    """
+    Reset the peak that `peak_traced_memory` reports, e.g. right after
+        `tracemalloc.start()` to forget an earlier tracing session.
+    """
+    global _reset_peak
+    _reset_peak = 0
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+@contextlib.contextmanager
+def timed(callback, phase, n_pixels=0, **info):
+    """
+    Time the body of a `with` block and report it to `callback`.
+
+    The callback receives one event dictionary with the `phase` name, the
+        elapsed `seconds`, the number of `pixels` processed (the block can
+        update it through the dictionary `with ... as event` gives), the peak
+        `bytes` allocated above what was in use when the phase began (None
+        unless `tracemalloc` is tracing), and any extra `info` such as the
+        iteration number. Phases can be nested; an inner phase's peak also
+        counts toward the phases around it. The process-wide peak is kept
+        in `peak_traced_memory`.
+
+    Does nothing if `callback` is None.
+    """
+    global _reset_peak
+    event = dict(phase=phase, pixels=n_pixels, **info)
+    if callback is None:
+        yield event
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if _open_peaks:
+            _open_peaks[-1] = max(_open_peaks[-1], peak)
+        _reset_peak = max(_reset_peak, peak)
+        tracemalloc.reset_peak()
+        _open_peaks.append(current)
+    start = time.perf_counter()
+    try:
+        yield event
+    finally:
+        seconds = time.perf_counter() - start
+        n_bytes = None
+        if tracing:
+            peak = max(_open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _open_peaks:
+                _open_peaks[-1] = max(_open_peaks[-1], peak)
+            n_bytes = peak - current
+        event.update(seconds=seconds, bytes=n_bytes)
+        callback(event)
+
+
+class Timings:
+    """
+    A callback for `run_gibbs` and `run_em` that keeps every event it is
+        given and can summarize them per phase.
+
+    Args:
+        forward: optional callback that also receives every event
+
+    Attributes:
+        events: list of the event dictionaries, in the order they ended
+    """
+
+    def __init__(self, forward=None):
+        self.forward = forward
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+        if self.forward is not None:
+            self.forward(event)
+
+    def summary(self):
+        """
+        Totals per phase: a dictionary from each phase name to its `count`,
+            total `seconds` and `pixels`, `pixels_per_second`, and largest
+            `bytes` (None if memory wasn't traced).
+        """
+        phases = {}
+        for event in self.events:
+            total = phases.setdefault(event["phase"], {
+                "count": 0, "seconds": 0.0, "pixels": 0, "bytes": None})
+            total["count"] += 1
+            total["seconds"] += event["seconds"]
+            total["pixels"] += event["pixels"]
+            if event["bytes"] is not None:
+                total["bytes"] = max(total["bytes"] or 0, event["bytes"])
+        for total in phases.values():
+            total["pixels_per_second"] = total["pixels"] / max(total["seconds"], 1e-12)
+        return phases
@@ -0,0 +1,81 @@
+import numpy as np
+
+from src.potentials import check_params, conditionals_from_counts
+from src.utils import get_neighborhood
+
+SCHEDULES = ["parallel", "checkerboard"]
+
+
+def run_mean_field(noisy_arr, n_colors=2, beta=1, J=None, mu=None, n_iter=50,
+                   tol=1e-4, damping=0.5, schedule="parallel", init=None):
+    """
+    Approximate p(Z | X) with a fully factorized distribution q(Z) using
+        mean-field variational inference.
+
+    Each update replaces the neighbor colors in the `potts_potential`
+        conditional with their expected counts under the current q:
+        q_ij(k) is proportional to
+        exp(beta * (sum_{n in N(ij)} sum_b q_n(b) J[k, b] + mu[k, orig_ij])).
+
+    Args:
+        noisy_arr: the observed noisy image, or a 3D stack of images
+        n_colors: the number of colors
+        beta, J, mu: hyperparameters, as in `potts_potential`. For a stack
+            of N images, J and mu may also be `(N, n_colors, n_colors)`.
+        n_iter: the maximum number of update sweeps
+        tol: stop once no marginal probability changes by more than `tol`
+            in a sweep
+        damping: the weight kept on the old marginals in each update, from
+            0 (no damping) up to, but not including, 1. Parallel updates can
+            oscillate without it.
+        schedule: "parallel" updates every pixel at once; "checkerboard"
+            updates one half of the grid given the other, which is plain
+            coordinate ascent and converges without damping
+        init: optional starting marginals of shape
+            `noisy_arr.shape + (n_colors,)`; defaults to a one-hot encoding
+            of `noisy_arr`
+
+    Returns:
+        q: array of shape `noisy_arr.shape + (n_colors,)` where `q[..., k]`
+            is the approximate marginal probability that a pixel has color k
+        info: a dictionary with the number of sweeps run (`n_iter`), the
+            largest change in each sweep (`deltas`), and whether the
+            marginals converged within `tol` (`converged`)
+    """
+    assert schedule in SCHEDULES, f"schedule must be one of {SCHEDULES}"
+    assert 0 <= damping < 1
+    J, mu = check_params(J, mu, n_colors, batch_shape=noisy_arr.shape[:-2])
+    neighborhood = get_neighborhood(noisy_arr.shape[-2:])
+
+    if init is None:
+        q = np.eye(n_colors)[noisy_arr]
+    else:
+        assert init.shape == noisy_arr.shape + (n_colors,)
+        q = init.astype(float)
+
+    if schedule == "checkerboard":
+        ii, jj = np.indices(noisy_arr.shape[-2:])
+        halves = [(ii + jj) % 2 == 0, (ii + jj) % 2 == 1]
+
+    deltas = []
+    converged = False
+    for _ in range(n_iter):
+        old_q = q.copy()
+        if schedule == "parallel":
+            expected = neighborhood.neighbor_sum(q)
+            new_q = conditionals_from_counts(expected, noisy_arr, beta, J, mu)
+            q = damping * q + (1 - damping) * new_q
+        else:
+            for half in halves:
+                expected = neighborhood.neighbor_sum(q)[..., half, :]
+                new_q = conditionals_from_counts(
+                    expected, noisy_arr[..., half], beta, J, mu)
+                q[..., half, :] = damping * q[..., half, :] + (1 - damping) * new_q
+
+        deltas.append(np.max(np.abs(q - old_q)))
+        if deltas[-1] < tol:
+            converged = True
+            break
+
+    info = {"n_iter": len(deltas), "deltas": deltas, "converged": converged}
+    return q, info
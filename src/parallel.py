@@ -0,0 +1,100 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import numpy as np
+
+from src.utils import get_rng
+
+
+def run_chains(orig_arr, n_iter, n_chains=2, n_workers=None, seed=None,
+               **gibbs_kwargs):
+    """
+    Run `n_chains` independent Gibbs chains on the same image, spread across
+        a pool of worker processes.
+
+    `orig_arr` is copied once into a shared memory block that every worker
+        reads from, rather than being pickled into each task.
+
+    Args:
+        orig_arr: the observed noisy image array
+        n_iter: the number of Gibbs iterations per chain
+        n_chains: how many independent chains to run
+        n_workers: size of the process pool. Defaults to one worker per chain,
+            up to the number of CPUs. With `n_workers=1` the chains run one
+            after another in this process.
+        seed: a `np.random.Generator`, int or `np.random.SeedSequence` that
+            the per-chain streams are spawned from (see `get_rng`). If None,
+            it is drawn from the global `np.random` state, so
+            `np.random.seed` still makes runs reproducible.
+        gibbs_kwargs: passed on to `run_gibbs` (n_colors, beta, J, mu, ...).
+            If it includes a `ColorCounts` as `counts` or `GibbsDiagnostics`
+            as `diagnostics`, each chain fills its own copy and they are all
+            merged into it.
+
+    Returns:
+        chains: a list of `n_chains` lists, each holding one chain's samples
+            in the format `run_gibbs` returns.
+    """
+    assert n_chains >= 1
+    if n_workers is None:
+        n_workers = min(n_chains, os.cpu_count() or 1)
+
+    # Each chain gets its own stream, and chain k always gets the k-th one
+    #   regardless of which worker ends up running it.
+    chain_rngs = get_rng(seed).spawn(n_chains)
+
+    counts = gibbs_kwargs.pop("counts", None)
+    diagnostics = gibbs_kwargs.pop("diagnostics", None)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, orig_arr.nbytes))
+    try:
+        shared = np.ndarray(orig_arr.shape, dtype=orig_arr.dtype, buffer=shm.buf)
+        shared[:] = orig_arr
+        tasks = [(shm.name, orig_arr.shape, orig_arr.dtype.str, n_iter,
+                  chain_rng, counts, diagnostics, gibbs_kwargs)
+                 for chain_rng in chain_rngs]
+        del shared
+
+        if n_workers == 1:
+            chains = [_run_chain(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(n_workers) as pool:
+                chains = pool.map(_run_chain, tasks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for samples, chain_counts, chain_diagnostics in chains:
+        if counts is not None:
+            counts.merge(chain_counts)
+        if diagnostics is not None:
+            diagnostics.merge(chain_diagnostics)
+    return [samples for samples, _, _ in chains]
+
+
+def _run_chain(task):
+    """
+    Worker entry point: attach to the shared image and run one chain.
+        Returns the chain's samples, `ColorCounts` and `GibbsDiagnostics`
+        (either of which may be None).
+    """
+    # Imported here because src.gibbs imports this module
+    from src.gibbs import run_gibbs
+
+    shm_name, shape, dtype, n_iter, chain_rng, counts, diagnostics, gibbs_kwargs = task
+    if counts is not None:
+        counts = counts.empty_copy()
+    if diagnostics is not None:
+        diagnostics = diagnostics.empty_copy()
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        orig_arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # run_gibbs copies orig_arr, so no sample refers to the shared buffer
+        samples = run_gibbs(orig_arr, n_iter, counts=counts,
+                            diagnostics=diagnostics, rng=chain_rng,
+                            **gibbs_kwargs)
+        del orig_arr
+    finally:
+        shm.close()
+    return samples, counts, diagnostics
@@ -1,6 +1,13 @@
+import collections
 import numpy as np
 
-from src.utils import get_neighbors
+from src.utils import get_neighbors, get_neighborhood, get_rng
+
+# Conditional tables from `conditional_table`, least recently used first
+_TABLE_CACHE = collections.OrderedDict()
+TABLE_CACHE_SIZE = 32
+# Larger tables (many colors or neighbors) are not worth building
+MAX_TABLE_ROWS = 4096
 
 
 def default_J(n_colors=2):
@@ -21,8 +28,11 @@ def default_J(n_colors=2):
         J: a 2D array with shape `(n_colors, n_colors)` where J[i, j] is the
         potential of a pixel taking value i when its neighbor has value j.
     """
-
-    raise NotImplementedError
+    # Scale color distance to [0, 1] so that identical neighbors get +1 and
+    #   the most distant colors get -1; with two colors this is the Ising J.
+    colors = np.arange(n_colors)
+    dist = np.abs(colors[:, None] - colors[None, :]) / max(1, n_colors - 1)
+    return 1 - 2 * dist
 
 
 def default_mu(n_colors=2):
@@ -41,11 +51,10 @@ def default_mu(n_colors=2):
         potential of a pixel taking value i when the observed noisy pixel takes
         value j.
     """
-
-    raise NotImplementedError
+    return 2 * np.eye(n_colors) - 1
 
 
-def calculate_J(arr, n_colors=2, smoothing=1):
+def calculate_J(arr, n_colors=2, smoothing=1, per_image=False):
     """
     Using an image arr, calculate a J matrix that can be used in
         `ising_potential` or `potts_potential`.
@@ -56,43 +65,89 @@ def calculate_J(arr, n_colors=2, smoothing=1):
     relate to a distribution over likely pixel configurations?
 
     Args:
-        arr: a 2D image array
+        arr: a 2D image array, or a 3D stack of same-sized images whose
+            adjacencies are pooled into a single J
         n_colors: the number of colors
-        smoothing: optional parameter depending on how you calculate J
+        smoothing: pseudocount added to every adjacency count before the
+            counts are normalized
+        per_image: for a 3D stack, return one J per image instead of pooling
 
     Returns:
         J: a 2D array with shape `(n_colors, n_colors)` where J[i, j] is the
         potential of a pixel taking value i when its neighbor has value j.
+        Each row is the smoothed fraction of neighbors of color-i pixels
+        that have color j. With `per_image`, shape `(N, n_colors, n_colors)`.
     """
-    assert len(arr.shape) == 2
-    assert np.all((arr >= 0) | (arr < n_colors))
+    assert len(arr.shape) in (2, 3)
+    assert np.all((arr >= 0) & (arr < n_colors))
 
-    raise NotImplementedError
+    n_groups = arr.shape[0] if per_image and arr.ndim == 3 else 1
+    counts = (
+        _pair_counts(arr[..., :, :-1], arr[..., :, 1:], n_colors, n_groups)
+        + _pair_counts(arr[..., :-1, :], arr[..., 1:, :], n_colors, n_groups))
+    # Every edge is a neighbor pair in both directions
+    counts = counts + np.swapaxes(counts, -1, -2)
+    return _normalize_rows(counts + smoothing)
 
 
-def calculate_mu(noisy_arr, orig_arr, n_colors=2, smoothing=1):
+def calculate_mu(noisy_arr, orig_arr, n_colors=2, smoothing=1, per_image=False):
     """
     Using an orig_arr as a reference and a noisy_arr as our observed image,
         calculate a mu matrix that can be used in `ising_potential` or
         `potts_potential`.
 
     Args:
-        noisy_arr: a 2D image array
-        orig_arr: a 2D image array
+        noisy_arr: a 2D image array, or a 3D stack of images
+        orig_arr: an image array of the same shape as `noisy_arr`
         n_colors: the number of colors
-        smoothing: optional parameter depending on how you calculate mu
+        smoothing: pseudocount added to every (true, noisy) count before the
+            counts are normalized
+        per_image: for a 3D stack, return one mu per image instead of pooling
 
     Returns:
         mu: a 2D array with shape `(n_colors, n_colors)` where mu[i, j] is the
             potential of a true pixel having value i when its noisy observed
-            pixel has value j.
+            pixel has value j. Each row is the smoothed fraction of color-i
+            pixels that were observed as color j. With `per_image`, shape
+            `(N, n_colors, n_colors)`.
     """
     assert noisy_arr.shape == orig_arr.shape
     for arr in [noisy_arr, orig_arr]:
-        assert len(arr.shape) == 2
-        assert np.all((arr >= 0) | (arr < n_colors))
+        assert len(arr.shape) in (2, 3)
+        assert np.all((arr >= 0) & (arr < n_colors))
 
-    raise NotImplementedError
+    n_groups = orig_arr.shape[0] if per_image and orig_arr.ndim == 3 else 1
+    counts = _pair_counts(orig_arr, noisy_arr, n_colors, n_groups)
+    return _normalize_rows(counts + smoothing)
+
+
+def _pair_counts(first, second, n_colors, n_groups=1):
+    """
+    Count co-occurrences of colors at matching positions of two arrays.
+        Returns `counts` where `counts[a, b]` is how often `first` is a
+        where `second` is b, via a single `np.bincount` over pair codes.
+        With `n_groups > 1`, the first axis indexes separate images and the
+        result has shape `(n_groups, n_colors, n_colors)`.
+    """
+    # Built in intp, since np.bincount would cast smaller codes to it anyway
+    codes = first.astype(np.intp) * n_colors + second.astype(np.intp)
+    if n_groups == 1:
+        shape = (n_colors, n_colors)
+    else:
+        shape = (n_groups, n_colors, n_colors)
+        group = np.arange(n_groups).reshape((-1,) + (1,) * (codes.ndim - 1))
+        codes += group * n_colors ** 2
+    return np.bincount(codes.ravel(), minlength=np.prod(shape)).reshape(shape)
+
+
+def _normalize_rows(counts):
+    """
+    Normalize each row of `counts` to sum to one, leaving all-zero rows
+        (colors that never appear) as zeros.
+    """
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape),
+                     where=totals > 0)
 
 
 def ising_potential(arr, i, j, orig, beta=1, J=None, mu=None):
@@ -129,19 +184,14 @@ def ising_potential(arr, i, j, orig, beta=1, J=None, mu=None):
     neighbors = get_neighbors(arr, i, j)
     assert np.all((neighbors == 0) | (neighbors == 1))
     assert orig in [0, 1]
+    J, mu = check_params(J, mu, 2)
 
-    if J is None:
-        J = np.zeros((2, 2))
-    else:
-        assert isinstance(J, np.ndarray)
-        assert J.shape == (2, 2)
-    if mu is None:
-        mu = np.zeros((2, 2))
-    else:
-        assert isinstance(mu, np.ndarray)
-        assert mu.shape == (2, 2)
-
-    raise NotImplementedError
+    counts = np.bincount(neighbors, minlength=2)
+    table = conditional_table(J, mu, beta, n_colors=2)
+    if table is not None:
+        # Copy, since the cached table is read-only and shared
+        return table[neighbor_codes(counts), orig].copy()
+    return conditionals_from_counts(counts, orig, beta, J, mu)
 
 
 def potts_potential(arr, i, j, orig, beta=1, J=None, mu=None, n_colors=3):
@@ -174,16 +224,240 @@ def potts_potential(arr, i, j, orig, beta=1, J=None, mu=None, n_colors=3):
     assert np.issubdtype(arr.dtype, np.integer)
     neighbors = get_neighbors(arr, i, j)
     assert np.all((neighbors >= 0) | (neighbors < n_colors))
+    J, mu = check_params(J, mu, n_colors)
+
+    counts = np.bincount(neighbors, minlength=n_colors)
+    table = conditional_table(J, mu, beta, n_colors=n_colors)
+    if table is not None:
+        # Copy, since the cached table is read-only and shared
+        return table[neighbor_codes(counts), orig].copy()
+    return conditionals_from_counts(counts, orig, beta, J, mu)
+
+
+def ising_conditionals(arr, orig_arr, beta=1, J=None, mu=None, mask=None):
+    """
+    Batched version of `ising_potential`: compute the conditional distribution
+        of every pixel in `arr` (or every pixel where `mask` is True) at once.
+
+    Args:
+        arr: 2D binary pixel array
+        orig_arr: the observed noisy image, same shape as `arr`
+        beta, J, mu: hyperparameters for the Ising model
+        mask: optional boolean array of the same shape as `arr`
+
+    Returns:
+        an array of shape `arr.shape + (2,)` or, if `mask` is given,
+        `(mask.sum(), 2)`, where each row matches what `ising_potential`
+        returns for that pixel.
+    """
+    return potts_conditionals(arr, orig_arr, beta=beta, J=J, mu=mu,
+                              n_colors=2, mask=mask)
+
+
+def potts_conditionals(arr, orig_arr, beta=1, J=None, mu=None, n_colors=3,
+                       mask=None, neighborhood=None):
+    """
+    Batched version of `potts_potential`: compute the conditional distribution
+        of every pixel in `arr` (or every pixel where `mask` is True) at once.
+
+    Args:
+        arr: 2D pixel array, or a 3D stack of same-sized images
+        orig_arr: the observed noisy image(s), same shape as `arr`
+        beta, J, mu: hyperparameters for the Potts model. For a stack of N
+            images, J and mu may also have shape `(N, n_colors, n_colors)`
+            to give each image its own parameters.
+        n_colors: the number of colors
+        mask: optional boolean array of shape `arr.shape[-2:]`; for a stack
+            the same pixels are selected from every image
+        neighborhood: optional `src.utils.Neighborhood` to use instead of
+            the default 4-connected one for `arr.shape[-2:]`
+
+    Returns:
+        an array of shape `arr.shape + (n_colors,)` or, if `mask` is given,
+        `arr.shape[:-2] + (mask.sum(), n_colors)`, where each row matches
+        what `potts_potential` returns for that pixel.
+    """
+    assert np.issubdtype(arr.dtype, np.integer)
+    assert arr.shape == orig_arr.shape
+    J, mu = check_params(J, mu, n_colors, batch_shape=arr.shape[:-2])
+
+    if neighborhood is None:
+        neighborhood = get_neighborhood(arr.shape[-2:])
+    counts = neighborhood.counts(arr, n_colors)
+    if mask is not None:
+        counts, orig_arr = counts[..., mask, :], orig_arr[..., mask]
+    max_neighbors = len(neighborhood.offsets)
+    table = conditional_table(J, mu, beta, n_colors, max_neighbors)
+    if table is not None:
+        return table[neighbor_codes(counts, max_neighbors), orig_arr]
+    return conditionals_from_counts(counts, orig_arr, beta, J, mu)
+
+
+def conditionals_from_counts(counts, orig, beta, J, mu):
+    """
+    Compute normalized conditionals from one-hot neighbor counts.
+
+    Args:
+        counts: array of shape `(..., n_colors)` where `counts[..., n]` is
+            the number of neighbors with color n
+        orig: observed noisy pixel(s), broadcastable to `counts.shape[:-1]`
+        beta, J, mu: `(n_colors, n_colors)` hyperparameters; neither may be
+            None. They may also be `(N, n_colors, n_colors)` stacks, in which
+            case the first axis of `counts` and `orig` indexes the N images.
 
+    Returns:
+        an array of the same shape as `counts` where the last axis sums to 1
+    """
+    # sum_n counts[n] * J[k, n] for each color k, plus mu[k, orig]
+    if J.ndim == 2:
+        scores = counts @ J.T
+    else:
+        J_T = np.swapaxes(J, -1, -2)
+        scores = counts @ J_T.reshape(
+            J_T.shape[:1] + (1,) * (counts.ndim - 3) + J_T.shape[1:])
+    if mu.ndim == 2:
+        scores = scores + mu.T[orig]
+    else:
+        image_idx = np.arange(mu.shape[0]).reshape((-1,) + (1,) * (orig.ndim - 1))
+        scores = scores + np.swapaxes(mu, -1, -2)[image_idx, orig]
+    return normalize_scores(beta * scores)
+
+
+def conditional_table(J, mu, beta=1, n_colors=2, max_neighbors=4):
+    """
+    Precompute every distinct conditional distribution a pixel can have.
+
+    A pixel's conditional depends only on how many of its neighbors take
+        each color and on its observed color, so there are at most
+        `(max_neighbors + 1) ** n_colors * n_colors` of them (50 for the
+        Ising model). Tables are cached, keyed on the bytes of J and mu, in
+        a bounded least-recently-used cache, so EM iterations and sweeps
+        with unchanged parameters reuse the same table.
+
+    Args:
+        J, mu: `(n_colors, n_colors)` hyperparameters, as in `potts_potential`
+        beta: the inverse temperature
+        n_colors: the number of colors
+        max_neighbors: the most neighbors any pixel can have
+
+    Returns:
+        a read-only array of shape `(n_rows, n_colors, n_colors)` where
+        `table[neighbor_codes(counts), orig]` is the conditional for a pixel
+        with neighbor color histogram `counts` and observed color `orig`,
+        or None if J or mu are per-image stacks or the table would have more
+        than `MAX_TABLE_ROWS` rows.
+    """
+    n_rows = (max_neighbors + 1) ** n_colors
+    if n_rows > MAX_TABLE_ROWS or any(x is not None and x.ndim != 2 for x in [J, mu]):
+        return None
+    J, mu = check_params(J, mu, n_colors)
+
+    key = (J.dtype.str, J.tobytes(), mu.dtype.str, mu.tobytes(), float(beta),
+           n_colors, max_neighbors)
+    if key in _TABLE_CACHE:
+        _TABLE_CACHE.move_to_end(key)
+        return _TABLE_CACHE[key]
+
+    # Row r holds the histogram whose `neighbor_codes` is r
+    counts = np.indices((max_neighbors + 1,) * n_colors).reshape(n_colors, -1)[::-1].T
+    table = conditionals_from_counts(counts[:, None, :].astype(float),
+                                     np.arange(n_colors), beta, J, mu)
+    table.flags.writeable = False
+    _TABLE_CACHE[key] = table
+    if len(_TABLE_CACHE) > TABLE_CACHE_SIZE:
+        _TABLE_CACHE.popitem(last=False)
+    return table
+
+
+def neighbor_codes(counts, max_neighbors=4):
+    """
+    Encode neighbor color histograms (the last axis of `counts`) as row
+        indices into a `conditional_table`.
+    """
+    powers = (max_neighbors + 1) ** np.arange(counts.shape[-1])
+    return counts @ powers
+
+
+def check_params(J, mu, n_colors, batch_shape=()):
+    """
+    Fill in the `None` defaults for J and mu and check their shapes. For a
+        stack of images (`batch_shape == (N,)`) each may also hold one
+        `(n_colors, n_colors)` matrix per image.
+    """
+    allowed = [(n_colors, n_colors), tuple(batch_shape) + (n_colors, n_colors)]
     if J is None:
         J = np.zeros((n_colors, n_colors))
     else:
         assert isinstance(J, np.ndarray)
-        assert J.shape == (n_colors, n_colors)
+        assert J.shape in allowed
     if mu is None:
         mu = np.zeros((n_colors, n_colors))
     else:
         assert isinstance(mu, np.ndarray)
-        assert mu.shape == (n_colors, n_colors)
+        assert mu.shape in allowed
+    return J, mu
+
 
-    raise NotImplementedError
+def image_energy(arr, orig_arr, J=None, mu=None, n_colors=2):
+    """
+    Compute the energy of a whole image under the model whose conditionals
+        `potts_potential` computes: minus the sum of J over every pair of
+        neighbors and of mu over every pixel. Lower energy means more likely;
+        p(Z | X) is proportional to exp(-beta * energy).
+
+    J is symmetrized, since each edge contributes to both of its pixels'
+        conditionals.
+
+    Args:
+        arr: 2D pixel array, or a 3D stack of images
+        orig_arr: the observed noisy image(s), same shape as `arr`
+        J, mu: hyperparameters, as in `potts_conditionals`
+        n_colors: the number of colors
+
+    Returns:
+        a float, or an array of one energy per image for a stack
+    """
+    J, mu = check_params(J, mu, n_colors, batch_shape=arr.shape[:-2])
+    J = (J + np.swapaxes(J, -1, -2)) / 2
+    if J.ndim == 3:
+        image_idx = np.arange(arr.shape[0])[:, None, None]
+        horizontal = J[image_idx, arr[..., :, :-1], arr[..., :, 1:]]
+        vertical = J[image_idx, arr[..., :-1, :], arr[..., 1:, :]]
+    else:
+        horizontal = J[arr[..., :, :-1], arr[..., :, 1:]]
+        vertical = J[arr[..., :-1, :], arr[..., 1:, :]]
+    if mu.ndim == 3:
+        field = mu[np.arange(arr.shape[0])[:, None, None], arr, orig_arr]
+    else:
+        field = mu[arr, orig_arr]
+    total = horizontal.sum(axis=(-2, -1)) + vertical.sum(axis=(-2, -1))
+    return -(total + field.sum(axis=(-2, -1)))
+
+
+def normalize_scores(scores):
+    """
+    Turn unnormalized log-potentials into a probability distribution over the
+        last axis, subtracting the max first so large `beta` can't overflow.
+    """
+    scores = scores - np.max(scores, axis=-1, keepdims=True)
+    probs = np.exp(scores)
+    return probs / probs.sum(axis=-1, keepdims=True)
+
+
+def sample_colors(probs, rng=None, u=None):
+    """
+    Draw one color index from each distribution along the last axis of
+        `probs` by inverting the CDF against one uniform per distribution.
+
+    Args:
+        probs: array of distributions over the last axis
+        rng: a `np.random.Generator` (or anything `get_rng` accepts) to draw
+            the uniforms from
+        u: uniforms of shape `probs.shape[:-1]` to use instead, e.g. a slice
+            of a batch drawn for a whole sweep at once
+    """
+    if u is None:
+        u = get_rng(rng).random(probs.shape[:-1])
+    cdf = np.cumsum(probs, axis=-1)
+    u = np.asarray(u)[..., None]
+    return np.minimum((u > cdf).sum(axis=-1), probs.shape[-1] - 1)
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def downsample(arr, n_colors=2, factor=2):
+    """
+    Shrink an image of color indices by majority vote: each
+        `factor x factor` block of pixels becomes one pixel with the block's
+        most common color (the smallest color index on ties). Blocks on the
+        bottom and right edges may be partial.
+
+    Args:
+        arr: a 2D image, or a 3D stack of images, of color indices
+        n_colors: the number of colors
+        factor: the block size
+
+    Returns:
+        a uint8 array of shape `arr.shape[:-2] + (ceil(height / factor),
+        ceil(width / factor))`
+    """
+    assert factor >= 1
+    height, width = arr.shape[-2:]
+    out_h, out_w = -(-height // factor), -(-width // factor)
+    # Pad with an extra color that never gets a vote
+    padded = np.full(arr.shape[:-2] + (out_h * factor, out_w * factor),
+                     n_colors, dtype=np.uint8)
+    padded[..., :height, :width] = arr
+    blocks = padded.reshape(arr.shape[:-2] + (out_h, factor, out_w, factor))
+
+    best = np.zeros(arr.shape[:-2] + (out_h, out_w), dtype=np.uint8)
+    best_count = np.zeros(best.shape, dtype=np.intp)
+    for k in range(n_colors):
+        count = np.count_nonzero(blocks == k, axis=(-3, -1))
+        better = count > best_count
+        best[better] = k
+        best_count[better] = count[better]
+    return best
+
+
+def upsample(arr, shape, factor=2, axes=(-2, -1)):
+    """
+    Undo `downsample`: repeat every pixel into a `factor x factor` block and
+        crop to `shape`.
+
+    Args:
+        arr: the coarse array
+        shape: the `(height, width)` to crop to
+        factor: the block size
+        axes: the two axes of `arr` to enlarge, e.g. `(-3, -2)` for
+            per-pixel marginals of shape `(..., height, width, n_colors)`
+
+    Returns:
+        an array of the same dtype as `arr`
+    """
+    for axis, size in zip(axes, shape):
+        assert arr.shape[axis] * factor >= size
+        arr = np.repeat(arr, factor, axis=axis)
+        arr = np.take(arr, np.arange(size), axis=axis)
+    return arr
+
+
+def build_pyramid(arr, n_colors=2, n_levels=3, factor=2, min_size=8):
+    """
+    Downsample `arr` repeatedly with `downsample`.
+
+    Args:
+        arr: a 2D image, or a 3D stack of images, of color indices
+        n_colors, factor: as in `downsample`
+        n_levels: the largest number of levels, including `arr` itself
+        min_size: stop before either side of a level would drop below this
+
+    Returns:
+        a list of arrays from finest (`arr`) to coarsest
+    """
+    levels = [arr]
+    while (len(levels) < n_levels
+           and min(levels[-1].shape[-2:]) >= factor * min_size):
+        levels.append(downsample(levels[-1], n_colors, factor))
+    return levels
@@ -0,0 +1,171 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import numpy as np
+
+from src.gibbs import KEEP, run_gibbs
+from src.potentials import check_params, image_energy
+from src.utils import get_rng
+
+
+def run_tempering(orig_arr, n_iter, n_colors=2, beta=1, betas=None, J=None,
+                  mu=None, schedule="checkerboard", swap_every=1,
+                  n_workers=None, keep="all", burnin=0, sample_every=1,
+                  rng=None):
+    """
+    Sample at `beta` with parallel tempering (replica exchange).
+
+    One Gibbs chain, or replica, runs at each inverse temperature of the
+        ladder `betas`, and the replicas are spread across a pool of worker
+        processes. Every `swap_every` sweeps, the sweeps stop and swaps
+        between adjacent temperatures k and k + 1 are proposed, alternating
+        between the even and the odd pairs. A swap is accepted with
+        probability `min(1, exp((betas[k] - betas[k + 1]) * (E_k - E_k+1)))`,
+        where E is the `image_energy` of each replica's state. That leaves
+        every replica's distribution unchanged, so the replica at `betas[0]`
+        still samples p(Z | X) at the target `beta`. It also lets states
+        that escaped a metastable mode at a hotter temperature move down to
+        the target.
+
+    As in `src.parallel.run_chains`, `orig_arr` and the replica states live
+        in shared memory, so only the random streams are sent to and from
+        the workers each round.
+
+    Args:
+        orig_arr: the observed noisy image, or a 3D stack of images. For a
+            stack, swaps are accepted or rejected separately per image.
+        n_iter: the number of Gibbs sweeps of every replica
+        n_colors, J, mu, schedule: as in `run_gibbs`. J is symmetrized, as
+            in `image_energy`, before the replicas use it, so the swaps and
+            the Gibbs sweeps agree on the distribution; for an asymmetric J,
+            the samples follow `(J + J.T) / 2`.
+        beta: the target inverse temperature
+        betas: the ladder of inverse temperatures, starting with `beta`;
+            defaults to 4 rungs falling geometrically from `beta` to
+            `beta / 4`. Tune it so every pair's acceptance rate is well
+            above zero.
+        swap_every: the number of sweeps between swap rounds
+        n_workers: size of the process pool; defaults to one worker per
+            replica, up to the number of CPUs. With `n_workers=1` the
+            replicas run one after another in this process.
+        keep, burnin, sample_every: which samples of the target replica to
+            return (see `run_gibbs`)
+        rng: the random stream (see `src.utils.get_rng`). Each replica and
+            the swap proposals get their own stream spawned from it, so
+            results don't depend on `n_workers`.
+
+    Returns:
+        samples: the target replica's samples, as a list of uint8 arrays
+        info: a dictionary with the ladder (`betas`), the number of swaps
+            proposed (`n_proposed`) and accepted (`n_accepted`) between each
+            pair of adjacent temperatures, their ratio (`acceptance`, NaN
+            for pairs that were never proposed), and the energy of each
+            replica after every round (`energies`)
+    """
+    assert keep in KEEP, f"keep must be one of {KEEP}"
+    assert orig_arr.ndim in (2, 3)
+    assert swap_every >= 1
+    if betas is None:
+        betas = beta * np.geomspace(1, 0.25, 4)
+    betas = np.asarray(betas, dtype=float)
+    assert np.isclose(betas[0], beta), "betas must start with the target beta"
+    n_temps = len(betas)
+    if n_workers is None:
+        n_workers = min(n_temps, os.cpu_count() or 1)
+
+    *replica_rngs, swap_rng = get_rng(rng).spawn(n_temps + 1)
+    J, mu = check_params(J, mu, n_colors, batch_shape=orig_arr.shape[:-2])
+    J = (J + np.swapaxes(J, -1, -2)) / 2
+    gibbs_kwargs = dict(n_colors=n_colors, J=J, mu=mu, schedule=schedule)
+
+    states_shape = (n_temps,) + orig_arr.shape
+    orig_shm = shared_memory.SharedMemory(create=True, size=max(1, orig_arr.nbytes))
+    states_shm = shared_memory.SharedMemory(create=True,
+                                            size=max(1, int(np.prod(states_shape))))
+    pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+    try:
+        shared = np.ndarray(orig_arr.shape, dtype=orig_arr.dtype, buffer=orig_shm.buf)
+        shared[:] = orig_arr
+        states = np.ndarray(states_shape, dtype=np.uint8, buffer=states_shm.buf)
+        states[:] = orig_arr
+
+        samples = []
+        energies = []
+        n_proposed = np.zeros(n_temps - 1, dtype=int)
+        n_accepted = np.zeros(n_temps - 1, dtype=int)
+        t = 0
+        for round_idx in range(-(-n_iter // swap_every)):
+            n_sweeps = min(swap_every, n_iter - t)
+            tasks = [(orig_shm.name, states_shm.name, orig_arr.shape,
+                      orig_arr.dtype.str, k, betas[k], n_sweeps, replica_rngs[k],
+                      k == 0 and keep != "none", gibbs_kwargs)
+                     for k in range(n_temps)]
+            if pool is None:
+                results = [_run_replica(task) for task in tasks]
+            else:
+                results = pool.map(_run_replica, tasks)
+
+            target_samples = results[0][0]
+            for i, sample in enumerate(target_samples, start=t):
+                if keep == "all" or (keep == "thinned" and i >= burnin
+                                     and (i - burnin) % sample_every == 0):
+                    samples.append(sample)
+            t += n_sweeps
+            if keep == "last" and target_samples:
+                samples[:] = target_samples[-1:]
+            replica_energy = np.array([energy for _, energy, _ in results])
+            replica_rngs = [replica_rng for _, _, replica_rng in results]
+
+            for k in range(round_idx % 2, n_temps - 1, 2):
+                log_ratio = (betas[k] - betas[k + 1]) * (replica_energy[k] - replica_energy[k + 1])
+                accept = np.log(swap_rng.random(np.shape(log_ratio))) < log_ratio
+                n_proposed[k] += np.size(accept)
+                n_accepted[k] += np.count_nonzero(accept)
+                if orig_arr.ndim == 3:
+                    colder, hotter = states[k, accept], states[k + 1, accept]
+                    states[k, accept], states[k + 1, accept] = hotter, colder
+                elif accept:
+                    states[[k, k + 1]] = states[[k + 1, k]]
+                replica_energy[[k, k + 1]] = np.where(
+                    accept, replica_energy[[k + 1, k]], replica_energy[[k, k + 1]])
+            energies.append(replica_energy)
+        del shared, states
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for shm in [orig_shm, states_shm]:
+            shm.close()
+            shm.unlink()
+
+    with np.errstate(invalid="ignore"):
+        acceptance = n_accepted / n_proposed
+    info = {"betas": betas, "n_proposed": n_proposed, "n_accepted": n_accepted,
+            "acceptance": acceptance, "energies": energies}
+    return samples, info
+
+
+def _run_replica(task):
+    """
+    Worker entry point: run one replica's sweeps from its shared state and
+        write the new state back. Returns the sweeps' samples (if asked for),
+        the new state's energy and the advanced random stream.
+    """
+    (orig_name, states_name, shape, dtype, k, beta, n_sweeps, rng, keep_all,
+     gibbs_kwargs) = task
+    orig_shm = shared_memory.SharedMemory(name=orig_name)
+    states_shm = shared_memory.SharedMemory(name=states_name)
+    try:
+        orig_arr = np.ndarray(shape, dtype=dtype, buffer=orig_shm.buf)
+        states = np.ndarray((k + 1,) + shape, dtype=np.uint8, buffer=states_shm.buf)
+        samples = run_gibbs(orig_arr, n_sweeps, beta=beta, init=states[k],
+                            keep="all" if keep_all else "last", rng=rng,
+                            **gibbs_kwargs)
+        states[k] = samples[-1]
+        energy = image_energy(samples[-1], orig_arr, gibbs_kwargs["J"],
+                              gibbs_kwargs["mu"], gibbs_kwargs["n_colors"])
+        del orig_arr, states
+    finally:
+        orig_shm.close()
+        states_shm.close()
+    return samples if keep_all else [], energy, rng
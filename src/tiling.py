@@ -0,0 +1,156 @@
+import numpy as np
+from PIL import Image
+
+from src.data import get_color_idxs
+from src.em import run_em
+from src.gibbs import run_gibbs, ColorCounts
+from src.utils import get_rng
+
+
+def open_noisy(path, mode="r"):
+    """
+    Open a noisy image without decoding it all into memory.
+
+    Args:
+        path: a `.npy` file of color indices, which is memory-mapped, or any
+            image file PIL can open, which is returned as a lazily loaded
+            `Image`. Note that PIL still decodes formats like PNG in full the
+            first time a region is read; convert those to `.npy` once with
+            `save_color_idxs` to keep memory bounded.
+        mode: the `np.load` memory-map mode for `.npy` files
+
+    Returns:
+        a `np.memmap` or a PIL `Image`, either of which `denoise_tiled` accepts
+    """
+    if str(path).endswith(".npy"):
+        return np.load(path, mmap_mode=mode)
+    return Image.open(path)
+
+
+def save_color_idxs(image, path, n_colors=2, rows_per_chunk=256):
+    """
+    Convert a greyscale PIL image into a memory-mapped `.npy` file of color
+        indices, `rows_per_chunk` rows at a time.
+
+    Returns:
+        the output `np.memmap`
+    """
+    width, height = image.size
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8,
+                                    shape=(height, width))
+    for top in range(0, height, rows_per_chunk):
+        bottom = min(height, top + rows_per_chunk)
+        out[top:bottom] = _read_region(image, (slice(top, bottom), slice(0, width)),
+                                       n_colors)
+    out.flush()
+    return out
+
+
+def iter_tiles(shape, tile_size=256, halo=8):
+    """
+    Split a 2D `shape` into tiles, each padded with up to `halo` pixels of
+        context on every side that is not the image border.
+
+    Yields:
+        (outer, inner) pairs: `outer` is a tuple of slices into the image
+        covering the tile plus its halo, and `inner` is a tuple of slices
+        into that outer region covering just the tile.
+    """
+    height, width = shape
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            bottom = min(height, top + tile_size)
+            right = min(width, left + tile_size)
+            outer_top, outer_left = max(0, top - halo), max(0, left - halo)
+            outer_bottom = min(height, bottom + halo)
+            outer_right = min(width, right + halo)
+
+            outer = (slice(outer_top, outer_bottom), slice(outer_left, outer_right))
+            inner = (slice(top - outer_top, bottom - outer_top),
+                     slice(left - outer_left, right - outer_left))
+            yield outer, inner
+
+
+def denoise_tiled(noisy, out, n_colors=2, tile_size=256, halo=8,
+                  method="gibbs", n_gibbs_iters=10, burnin=5, sample_every=1,
+                  n_em_iters=3, beta=1, J=None, mu=None, smoothing=1,
+                  schedule="checkerboard", rng=None):
+    """
+    Denoise an image too large to process in one piece by running Gibbs
+        sampling (or EM) on overlapping tiles.
+
+    Each tile is sampled together with a `halo` of surrounding pixels, so
+        pixels near a tile edge are still conditioned on their real
+        neighbors; only the tile's interior is written to `out`. Peak memory
+        depends on `tile_size` and `halo`, not on the size of the image.
+
+    Args:
+        noisy: a 2D array-like of color indices (e.g., a `np.memmap` from
+            `open_noisy`), or a greyscale PIL `Image` that is converted to
+            color indices one tile at a time
+        out: a path for a new `.npy` file to memory-map the output into, or
+            an existing writable 2D array of the same shape as `noisy`
+        n_colors: the number of colors
+        tile_size: the side length of each tile, before the halo is added
+        halo: how many pixels of context to add around each tile
+        method: "gibbs" to take the mode of a Gibbs chain with fixed J and mu,
+            or "em" to run `run_em` on each tile starting from J and mu
+        n_gibbs_iters, burnin, sample_every, n_em_iters, beta, J, mu,
+            smoothing, schedule: passed on to `run_gibbs` / `run_em`
+        rng: each tile samples from its own stream spawned from this (see
+            `src.utils.get_rng`), in the order `iter_tiles` yields them
+
+    Returns:
+        out: the array holding the denoised color indices
+    """
+    assert method in ["gibbs", "em"]
+    if isinstance(noisy, Image.Image):
+        shape = (noisy.size[1], noisy.size[0])
+    else:
+        shape = noisy.shape
+    assert len(shape) == 2
+
+    if isinstance(out, np.ndarray):
+        assert out.shape == shape
+    else:
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=np.uint8,
+                                        shape=shape)
+
+    rng = get_rng(rng)
+    for outer, inner in iter_tiles(shape, tile_size, halo):
+        # Spawning one child at a time gives the same streams as spawning
+        #   them all up front, without holding one per tile
+        tile_rng = rng.spawn(1)[0]
+        tile = _read_region(noisy, outer, n_colors)
+        if method == "em":
+            em_samples, _ = run_em(
+                tile, n_colors=n_colors, n_em_iters=n_em_iters,
+                n_gibbs_iters=n_gibbs_iters, burnin=burnin,
+                sample_every=sample_every, beta=beta, smoothing=smoothing,
+                mu=mu, J=J, schedule=schedule, rng=tile_rng)
+            denoised = em_samples[-1]
+        else:
+            counts = ColorCounts(tile.shape, n_colors, burnin=burnin,
+                                 sample_every=sample_every)
+            run_gibbs(tile, n_gibbs_iters, n_colors=n_colors, beta=beta, J=J,
+                      mu=mu, schedule=schedule, counts=counts, keep="none",
+                      rng=tile_rng)
+            denoised = counts.mode()
+        out[outer][inner] = denoised[inner]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _read_region(noisy, region, n_colors):
+    """
+    Read one region of `noisy` into memory as an integer array of color
+        indices.
+    """
+    rows, cols = region
+    if isinstance(noisy, Image.Image):
+        box = (cols.start, rows.start, cols.stop, rows.stop)
+        arr = np.array(noisy.crop(box).convert("L"))
+        return get_color_idxs(arr, n_colors)
+    return np.array(noisy[rows, cols], dtype=np.uint8)
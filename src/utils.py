@@ -1,13 +1,34 @@
 # You should not need to edit these functions.
 
 from datetime import datetime
-import matplotlib.pyplot as plt
+import functools
 import numpy as np
 import os
 
 from src.data import color_idxs_to_image
 
 
+def get_rng(rng=None):
+    """
+    Turn `rng` into a `np.random.Generator`.
+
+    Args:
+        rng: a Generator, which is returned as is; an int or
+            `np.random.SeedSequence` to seed a new one; or None to seed a new
+            one from the global `np.random` state, so `np.random.seed` still
+            makes runs reproducible
+
+    Returns:
+        a `np.random.Generator`. Use its `spawn` method to derive independent
+        streams for chains, tiles or images.
+    """
+    if isinstance(rng, np.random.Generator):
+        return rng
+    if rng is None:
+        rng = np.random.randint(2 ** 31)
+    return np.random.default_rng(rng)
+
+
 def get_neighbors(arr, i, j):
     """
     Given a 2D array of pixels `arr` and a centerpoint
@@ -23,23 +44,178 @@ def get_neighbors(arr, i, j):
     Returns:
         1-D array of values taken by neighbors of (i, j)
     """
-
     assert isinstance(arr, np.ndarray)
     assert len(arr.shape) == 2
-    assert i < arr.shape[0] and j < arr.shape[1]
+    assert 0 <= i < arr.shape[0] and 0 <= j < arr.shape[1]
+    return get_neighborhood(arr.shape).neighbors(arr, i, j)
+
+
+# (row, col) offsets of each neighbor, in the order `get_neighbors` returns them
+OFFSETS = {
+    4: [(-1, 0), (0, -1), (1, 0), (0, 1)],
+    8: [(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)],
+}
+
+
+class Neighborhood:
+    """
+    Neighbor lookup tables for every pixel of an image with a fixed shape.
+        Build one per image shape (see `get_neighborhood`) and reuse it instead
+        of slicing out each pixel's neighbors on every call.
+
+    Attributes:
+        shape: the (height, width) of the images this can be used with
+        offsets: list of (row, col) offsets, one per neighbor slot
+        index: int array of shape `(height * width, len(offsets))` holding the
+            flat index of each neighbor of each flat pixel index, or -1 where
+            that neighbor would fall outside the image
+        valid: boolean array, the same shape as `index`, marking real neighbors
+        n_neighbors: int array of shape `shape` with each pixel's neighbor count
+
+    `index`, `valid` and `n_neighbors` are only built the first time they are
+        used, since the whole-image samplers only need `slices`.
+    """
+
+    def __init__(self, shape, connectivity=4):
+        assert connectivity in OFFSETS, f"connectivity must be one of {list(OFFSETS)}"
+        assert len(shape) == 2
+        self.shape = tuple(shape)
+        self.connectivity = connectivity
+        self.offsets = OFFSETS[connectivity]
+
+        # Scratch buffers reused by `counts`, only for the latest
+        #   (n_colors, arr.shape) it was called with
+        self._buffer_key = None
+        self._buffers = None
+
+    @functools.cached_property
+    def valid(self):
+        height, width = self.shape
+        n_rows, n_cols = self._neighbor_coords()
+        return (n_rows >= 0) & (n_rows < height) & (n_cols >= 0) & (n_cols < width)
+
+    @functools.cached_property
+    def index(self):
+        n_rows, n_cols = self._neighbor_coords()
+        return np.where(self.valid, n_rows * self.shape[1] + n_cols, -1)
 
-    neighbors = np.concatenate([
-        arr[max(0, i - 1):i, j],
-        arr[i, max(0, j - 1):j],
-        arr[i + 1: min(i + 2, arr.shape[0]), j],
-        arr[i, j + 1: min(j + 2, arr.shape[0])],
-    ], axis=0)
+    @functools.cached_property
+    def n_neighbors(self):
+        return self.valid.sum(axis=1).reshape(self.shape)
 
-    return neighbors
+    def _neighbor_coords(self):
+        rows, cols = np.indices(self.shape).reshape(2, -1, 1)
+        d_rows, d_cols = np.array(self.offsets).T
+        return rows + d_rows, cols + d_cols
+
+    def neighbors(self, arr, i, j):
+        """
+        Return the values of the neighbors of `arr[i, j]`, in `offsets` order.
+        """
+        assert arr.shape == self.shape
+        assert 0 <= i < self.shape[0] and 0 <= j < self.shape[1]
+        flat = i * self.shape[1] + j
+        return arr.ravel()[self.index[flat][self.valid[flat]]]
+
+    def counts(self, arr, n_colors):
+        """
+        For every pixel, count how many of its neighbors take each color.
+            `arr` may also be a stack of images whose last two axes match
+            `shape`; each image is handled independently.
+
+        The result is written into a buffer owned by this object, so it is
+            overwritten by the next call; copy it if you need to keep it
+            around. Only the buffers for the latest `n_colors` and array
+            shape are kept.
+
+        Returns:
+            an int8 array of shape `arr.shape + (n_colors,)`
+        """
+        assert arr.shape[-2:] == self.shape
+        key = (n_colors, arr.shape)
+        if key != self._buffer_key:
+            self._buffer_key = key
+            self._buffers = (
+                np.eye(n_colors, dtype=np.int8),
+                np.empty(arr.shape + (n_colors,), dtype=np.int8),
+                np.empty(arr.shape + (n_colors,), dtype=np.int8))
+        eye, onehot, counts = self._buffers
+
+        np.take(eye, arr, axis=0, out=onehot)
+        return self.neighbor_sum(onehot, out=counts)
+
+    def neighbor_sum(self, values, out=None):
+        """
+        For every pixel, add up `values` over its neighbors. With one-hot
+            colors this gives `counts`; with per-pixel color probabilities
+            (as in mean-field inference) it gives expected neighbor counts.
+
+        Args:
+            values: array of shape `(..., height, width, n)`
+            out: optional array of the same shape to write the result into
+
+        Returns:
+            an array of the same shape as `values`
+        """
+        assert values.shape[-3:-1] == self.shape
+        if out is None:
+            out = np.zeros_like(values)
+        else:
+            out.fill(0)
+        # The last axis is not spatial, so the slices apply to axes -3 and -2
+        last = (slice(None),)
+        for dst, src in self.slices():
+            out[(Ellipsis,) + dst + last] += values[(Ellipsis,) + src + last]
+        return out
+
+    def slices(self):
+        """
+        For each offset, yield a `(dst, src)` pair of 2D slices such that
+            `arr[src]` lines up each pixel in `arr[dst]` with that neighbor.
+        """
+        for d_row, d_col in self.offsets:
+            dst = (_shifted(d_row, self.shape[0], False),
+                   _shifted(d_col, self.shape[1], False))
+            src = (_shifted(d_row, self.shape[0], True),
+                   _shifted(d_col, self.shape[1], True))
+            yield dst, src
+
+
+def _shifted(offset, size, is_src):
+    """
+    Slice of one axis of length `size` for a neighbor at `offset`; the
+        source slice is the destination slice moved by `offset`.
+    """
+    if is_src:
+        return slice(max(0, offset), size + min(0, offset))
+    return slice(max(0, -offset), size - max(0, offset))
+
+
+@functools.lru_cache(maxsize=16)
+def grid_edges(shape):
+    """
+    Flat pixel indices of both ends of every horizontal and vertical edge in
+        an image (or a stack of images) of the given shape.
+    """
+    idx = np.arange(np.prod(shape)).reshape(shape)
+    first = np.concatenate([idx[..., :, :-1].ravel(), idx[..., :-1, :].ravel()])
+    second = np.concatenate([idx[..., :, 1:].ravel(), idx[..., 1:, :].ravel()])
+    return first, second
+
+
+@functools.lru_cache(maxsize=32)
+def get_neighborhood(shape, connectivity=4):
+    """
+    Return the `Neighborhood` for images of `shape`, building it only the
+        first time each shape is seen.
+    """
+    return Neighborhood(shape, connectivity)
 
 
 def mean_squared_error(original_image, reconstructed_image):
-    return np.mean(np.square(original_image - reconstructed_image))
+    # Cast first so uint8 color indices can't wrap around when subtracted
+    diff = np.asarray(original_image, dtype=float) - reconstructed_image
+    return np.mean(np.square(diff))
 
 
 def plot_samples(samples, orig_image_arr, noisy_image_arr, n_colors=2, show=True, save=True):
@@ -53,6 +229,8 @@ def plot_samples(samples, orig_image_arr, noisy_image_arr, n_colors=2, show=True
         show: should we show the resulting images on the screen?
         save: should we save the resulting images to file?
     """
+    # Imported here so that modules using the other helpers don't pay for it
+    import matplotlib.pyplot as plt
 
     all_mses = [mean_squared_error(orig_image_arr, samples[idx])
                 for idx in range(len(samples))]
@@ -196,3 +196,20 @@ def grade_assignment(request):
         print(f'{note} {i}')
     print("======================")
     save_json(report, 'tests/report.json')
+
+
+@pytest.fixture
+def noisy_square():
+    """
+    Build a binary test image, a square of ones on a background of zeros, and
+    a copy with every pixel flipped with probability `noise`. Returns a
+    function `make(size=20, noise=0.1, seed=0)` that gives
+    `(image_arr, noisy_arr)`, both `(size, size)` int arrays.
+    """
+    def make(size=20, noise=0.1, seed=0):
+        image_arr = np.zeros((size, size), dtype=int)
+        image_arr[size // 4:3 * size // 4, size // 6:3 * size // 5] = 1
+        rng = np.random.default_rng(seed)
+        flip = rng.random(image_arr.shape) < noise
+        return image_arr, np.where(flip, 1 - image_arr, image_arr)
+    return make
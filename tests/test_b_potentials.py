@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 
 # Simple 3x3 "images" for tests
@@ -197,3 +198,121 @@ def test_potts_potential1():
     # Most of potential should be on 2 or 3
     assert pot20_orig3_J[2:].sum() > 0.8
     assert pot20_orig2_J[2:].sum() > 0.8
+
+
+def test_batched_conditionals():
+    from src.potentials import ising_potential, potts_potential
+    from src.potentials import ising_conditionals, potts_conditionals
+    from src.potentials import default_J, default_mu
+
+    J, mu = default_J(n_colors=2), default_mu(n_colors=2)
+    orig = 1 - bin_arr
+    batched = ising_conditionals(bin_arr, orig, beta=2, J=J, mu=mu)
+    assert batched.shape == (3, 3, 2)
+    for i in range(3):
+        for j in range(3):
+            pot = ising_potential(bin_arr, i, j, orig[i, j], beta=2, J=J, mu=mu)
+            assert np.allclose(batched[i, j], pot)
+
+    n_colors = 4
+    J, mu = default_J(n_colors=n_colors), default_mu(n_colors=n_colors)
+    orig = (nonbin_arr + 1) % n_colors
+    mask = nonbin_arr > 0
+    batched = potts_conditionals(nonbin_arr, orig, J=J, mu=mu,
+                                 n_colors=n_colors, mask=mask)
+    assert batched.shape == (mask.sum(), n_colors)
+    for row, (i, j) in zip(batched, np.argwhere(mask)):
+        pot = potts_potential(nonbin_arr, i, j, orig[i, j], J=J, mu=mu,
+                              n_colors=n_colors)
+        assert np.allclose(row, pot)
+
+
+def test_neighborhood():
+    from src.utils import get_neighbors, Neighborhood
+
+    # Non-square images used to lose the right-hand neighbor
+    wide = np.arange(12).reshape(2, 6)
+    assert np.all(get_neighbors(wide, 0, 2) == [1, 8, 3])
+    assert np.all(get_neighbors(wide, 1, 4) == [4, 9, 11])
+    assert np.all(get_neighbors(wide, 1, 5) == [5, 10])
+    # Out-of-bounds coordinates must not wrap around or spill into other rows
+    for i, j in [(0, 6), (-1, 0), (2, 0)]:
+        with pytest.raises(AssertionError):
+            get_neighbors(wide, i, j)
+    with pytest.raises(AssertionError):
+        get_neighbors(wide[None], 0, 0)
+
+    nbhd = Neighborhood(wide.shape, connectivity=8)
+    assert "index" not in vars(nbhd)
+    assert np.all(nbhd.neighbors(wide, 0, 0) == [6, 1, 7])
+    assert np.all(nbhd.n_neighbors == [[3, 5, 5, 5, 5, 3], [3, 5, 5, 5, 5, 3]])
+
+    counts = nbhd.counts(wide % 3, n_colors=3)
+    assert counts.shape == (2, 6, 3)
+    for i in range(2):
+        for j in range(6):
+            expected = np.bincount(nbhd.neighbors(wide % 3, i, j), minlength=3)
+            assert np.all(counts[i, j] == expected)
+
+
+def test_calculate_stacked():
+    from src.utils import get_neighbors
+    from src.potentials import calculate_J, calculate_mu
+
+    n_colors = 3
+    np.random.seed(0)
+    images = np.random.randint(0, n_colors, size=(4, 5, 6))
+    noisy = np.random.randint(0, n_colors, size=(4, 5, 6))
+
+    # Compare against counting with a loop over every pixel's neighbors
+    counts = np.zeros((n_colors, n_colors)) + 0.5
+    for image in images:
+        for i in range(5):
+            for j in range(6):
+                for neighbor in get_neighbors(image, i, j):
+                    counts[image[i, j], neighbor] += 1
+    expected = counts / counts.sum(axis=1, keepdims=True)
+    assert np.allclose(calculate_J(images, n_colors, smoothing=0.5), expected)
+
+    single = calculate_J(images[0], n_colors, smoothing=0)
+    assert np.allclose(calculate_J(images[[0, 0]], n_colors, smoothing=0), single)
+
+    mu = calculate_mu(noisy, images, n_colors, smoothing=0)
+    pooled = sum(calculate_mu(noisy[k:k + 1], images[k:k + 1], n_colors, 0)
+                 * np.bincount(images[k].ravel(), minlength=n_colors)[:, None]
+                 for k in range(4))
+    pooled /= pooled.sum(axis=1, keepdims=True)
+    assert np.allclose(mu, pooled)
+
+
+def test_conditional_table():
+    from src import potentials
+    from src.potentials import (conditional_table, conditionals_from_counts,
+                                neighbor_codes, default_J, default_mu)
+
+    for n_colors in [2, 3]:
+        J, mu = default_J(n_colors), default_mu(n_colors)
+        table = conditional_table(J, mu, beta=0.7, n_colors=n_colors)
+        assert table is conditional_table(J.copy(), mu.copy(), 0.7, n_colors)
+        assert table is not conditional_table(J, mu, 0.5, n_colors)
+        assert not table.flags.writeable
+
+        np.random.seed(0)
+        counts = np.random.multinomial(4, np.ones(n_colors) / n_colors, size=20)
+        orig = np.random.randint(0, n_colors, size=20)
+        assert np.allclose(table[neighbor_codes(counts), orig],
+                           conditionals_from_counts(counts, orig, 0.7, J, mu))
+
+    assert conditional_table(np.zeros((3, 2, 2)), None, n_colors=2) is None
+    assert conditional_table(None, None, n_colors=8) is None
+
+    for beta in np.linspace(0, 1, potentials.TABLE_CACHE_SIZE + 5):
+        conditional_table(None, None, beta, n_colors=2)
+    assert len(potentials._TABLE_CACHE) == potentials.TABLE_CACHE_SIZE
+
+    # The single-pixel potentials hand back fresh, writable arrays
+    probs = potentials.ising_potential(bin_arr, 1, 1, 0, J=default_J(2), mu=default_mu(2))
+    probs /= probs.sum()
+    probs = potentials.potts_potential(nonbin_arr, 1, 1, 0, J=default_J(4),
+                                       mu=default_mu(4), n_colors=4)
+    probs /= probs.sum()
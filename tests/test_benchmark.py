@@ -0,0 +1,16 @@
+def test_benchmark():
+    from src.benchmark import run_benchmarks, compare_to_baseline
+
+    results = run_benchmarks(["ising_potential", "run_gibbs_checkerboard"],
+                             sizes=[16], n_colors_list=[2, 4], repeats=1)
+    # ising_potential only applies to two colors
+    assert [(r["name"], r["n_colors"]) for r in results] == [
+        ("ising_potential", 2), ("run_gibbs_checkerboard", 2),
+        ("run_gibbs_checkerboard", 4)]
+    assert all(r["pixels_per_second"] > 0 and r["peak_bytes"] > 0 for r in results)
+
+    baseline = {"results": [dict(r) for r in results]}
+    assert compare_to_baseline(results, baseline) == []
+    baseline["results"][0]["pixels_per_second"] *= 2
+    regressions = compare_to_baseline(results, baseline, tolerance=0.2)
+    assert len(regressions) == 1 and regressions[0][0] is results[0]
@@ -0,0 +1,71 @@
+import itertools
+import numpy as np
+
+
+def test_bp():
+    from src.potentials import image_energy
+    from src.bp import run_bp
+
+    # A single row is a tree, where BP is exact
+    np.random.seed(0)
+    beta, shape = 0.8, (1, 5)
+    for n_colors in [2, 3]:
+        J = np.random.randn(n_colors, n_colors)
+        mu = np.random.randn(n_colors, n_colors)
+        noisy = np.random.randint(0, n_colors, size=shape)
+
+        total, marginal, best, best_energy = 0, np.zeros(shape + (n_colors,)), None, np.inf
+        for bits in itertools.product(range(n_colors), repeat=np.prod(shape)):
+            z = np.array(bits).reshape(shape)
+            energy = beta * image_energy(z, noisy, J, mu, n_colors)
+            total += np.exp(-energy)
+            marginal += np.exp(-energy) * np.eye(n_colors)[z]
+            if energy < best_energy:
+                best, best_energy = z, energy
+        marginal /= total
+
+        for schedule in ["parallel", "checkerboard"]:
+            kwargs = dict(n_colors=n_colors, beta=beta, J=J, mu=mu, n_iter=200,
+                          tol=1e-10, schedule=schedule)
+            _, beliefs, info = run_bp(noisy, mode="sum", **kwargs)
+            assert info["converged"]
+            assert info["messages"].shape == (4,) + shape + (n_colors,)
+            assert np.allclose(beliefs, marginal)
+            image, _, _ = run_bp(noisy, mode="max", **kwargs)
+            assert image.dtype == np.uint8 and np.all(image == best)
+
+
+def test_em_bp(noisy_square):
+    from src.potentials import default_J, default_mu
+    from src.bp import run_bp
+    from src.em import run_em
+    from src.gibbs import ColorCounts, run_gibbs
+
+    n_colors = 2
+    _, noisy_arr = noisy_square()
+
+    # Loopy sum-product beliefs are close to the Gibbs marginals
+    kwargs = dict(n_colors=n_colors, mu=default_mu(n_colors), n_iter=500, tol=1e-10)
+    _, beliefs, info = run_bp(noisy_arr, J=default_J(n_colors), **kwargs)
+    assert info["converged"]
+    counts = ColorCounts(noisy_arr.shape, n_colors=n_colors, burnin=50)
+    run_gibbs(noisy_arr, 2000, n_colors=n_colors, J=default_J(n_colors),
+              mu=default_mu(n_colors), schedule="checkerboard", keep="none",
+              counts=counts, rng=0)
+    assert np.abs(beliefs - counts.marginals()).max() < 0.1
+
+    # Stacks with per-image parameters match running each image alone
+    J = np.stack([default_J(n_colors), 0.5 * default_J(n_colors)])
+    stack = np.stack([noisy_arr, noisy_arr])
+    _, beliefs, _ = run_bp(stack, J=J, **kwargs)
+    for n in range(2):
+        _, alone, _ = run_bp(noisy_arr, J=J[n], **kwargs)
+        assert np.allclose(beliefs[n], alone)
+
+    for inference in ["bp", "bp_max"]:
+        samples, extra_info = run_em(
+            noisy_arr, n_colors=n_colors, n_em_iters=3, J=default_J(n_colors),
+            mu=default_mu(n_colors), inference=inference, schedule="checkerboard")
+        assert len(samples) == 3
+        assert extra_info["beliefs"].shape == (20, 20, n_colors)
+        assert np.all(samples[-1] == np.argmax(extra_info["beliefs"], axis=-1))
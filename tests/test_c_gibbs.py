@@ -80,3 +80,309 @@ def test_gibbs_denoises():
     mse2 = mean_squared_error(image_arr, exp_image)
 
     assert mse1 > 2 * mse2, f"{mse2:.3f} should be half of {mse1:.3f}"
+
+
+def test_gibbs_checkerboard():
+    import itertools
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs, get_expected_image
+
+    n_colors = 2
+    J = default_J(n_colors=n_colors) / 2
+    mu = default_mu(n_colors=n_colors) / 2
+
+    np.random.seed(1)
+    random_image = np.random.randint(0, n_colors, size=(3, 3))
+    samples = run_gibbs(random_image, 2000, n_colors=n_colors, J=J, mu=mu,
+                        schedule="checkerboard")
+    assert len(samples) == 2000
+    assert samples[0].shape == random_image.shape
+
+    # Enumerate all 2^9 images to get the exact per-pixel marginals
+    total, marginal = 0, np.zeros(random_image.shape)
+    for bits in itertools.product(range(n_colors), repeat=random_image.size):
+        z = np.array(bits).reshape(random_image.shape)
+        weight = np.exp(J[z[:-1], z[1:]].sum() + J[z[:, :-1], z[:, 1:]].sum()
+                        + mu[z, random_image].sum())
+        total += weight
+        marginal += weight * z
+    marginal /= total
+
+    assert np.max(np.abs(np.mean(samples[100:], axis=0) - marginal)) < 0.05
+
+    image = get_expected_image(samples, burnin=100, sample_every=2)
+    assert np.all(image == (marginal > 0.5))
+
+
+def test_gibbs_multichain():
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs, get_expected_image
+
+    n_colors = 2
+    J = default_J(n_colors=n_colors)
+    mu = default_mu(n_colors=n_colors)
+
+    np.random.seed(0)
+    random_image = np.random.randint(0, n_colors, size=(5, 8))
+    kwargs = dict(n_colors=n_colors, J=J, mu=mu, schedule="checkerboard",
+                  n_chains=3)
+
+    np.random.seed(1)
+    chains = run_gibbs(random_image, 20, n_workers=2, **kwargs)
+    assert len(chains) == 3
+    assert all(len(chain) == 20 for chain in chains)
+    # Chains use independent random streams
+    assert not np.all(np.stack(chains[0]) == np.stack(chains[1]))
+
+    # The same seed gives the same chains whatever the worker count
+    np.random.seed(1)
+    serial = run_gibbs(random_image, 20, n_workers=1, **kwargs)
+    for chain, other in zip(chains, serial):
+        assert all(np.all(x == y) for x, y in zip(chain, other))
+
+    image = get_expected_image(chains, burnin=10, sample_every=2)
+    pooled = get_expected_image(sum([c[10::2] for c in chains], []), burnin=0)
+    assert np.all(image == pooled)
+
+
+def test_gibbs_color_counts():
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs, get_expected_image, ColorCounts
+
+    n_colors = 4
+    J = default_J(n_colors=n_colors)
+    mu = default_mu(n_colors=n_colors)
+
+    np.random.seed(0)
+    random_image = np.random.randint(0, n_colors, size=(6, 9))
+    counts = ColorCounts(random_image.shape, n_colors, burnin=3, sample_every=2)
+    samples = run_gibbs(random_image, 16, n_colors=n_colors, J=J, mu=mu,
+                        schedule="checkerboard", counts=counts)
+
+    assert counts.n_seen == 16
+    assert counts.n_kept == len(samples[3::2])
+    assert np.all(get_expected_image(counts)
+                  == get_expected_image(samples, burnin=3, sample_every=2))
+
+    marginals = counts.marginals()
+    assert marginals.shape == (6, 9, n_colors)
+    assert np.allclose(marginals.sum(axis=-1), 1)
+    onehot = np.eye(n_colors)[np.stack(samples[3::2])]
+    assert np.allclose(marginals, onehot.mean(axis=0))
+
+    # Counts from several chains are merged into one accumulator
+    counts = ColorCounts(random_image.shape, n_colors, burnin=3, sample_every=2)
+    chains = run_gibbs(random_image, 16, n_colors=n_colors, J=J, mu=mu,
+                       schedule="checkerboard", counts=counts, n_chains=2,
+                       n_workers=1)
+    assert counts.n_kept == 2 * len(samples[3::2])
+    assert np.all(get_expected_image(counts)
+                  == get_expected_image(chains, burnin=3, sample_every=2))
+
+
+def test_gibbs_retention():
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs, iter_gibbs, get_expected_image, ColorCounts
+
+    n_colors = 2
+    kwargs = dict(n_colors=n_colors, J=default_J(n_colors=n_colors),
+                  mu=default_mu(n_colors=n_colors), schedule="checkerboard")
+
+    np.random.seed(0)
+    random_image = np.random.randint(0, n_colors, size=(7, 4))
+
+    np.random.seed(1)
+    everything = run_gibbs(random_image, 12, keep="all", **kwargs)
+    np.random.seed(1)
+    lazy = [x.copy() for x in iter_gibbs(random_image, 12, **kwargs)]
+    assert all(np.all(x == y) for x, y in zip(everything, lazy))
+
+    np.random.seed(1)
+    thinned = run_gibbs(random_image, 12, keep="thinned", burnin=5,
+                        sample_every=3, **kwargs)
+    assert len(thinned) == len(everything[5::3])
+    assert all(np.all(x == y) for x, y in zip(thinned, everything[5::3]))
+
+    np.random.seed(1)
+    last = run_gibbs(random_image, 12, keep="last", **kwargs)
+    assert len(last) == 1 and np.all(last[0] == everything[-1])
+
+    np.random.seed(1)
+    counts = ColorCounts(random_image.shape, n_colors, burnin=5, sample_every=3)
+    assert run_gibbs(random_image, 12, keep="none", counts=counts, **kwargs) == []
+    assert np.all(get_expected_image(counts)
+                  == get_expected_image(everything, burnin=5, sample_every=3))
+
+
+def test_gibbs_batch():
+    from src.gibbs import run_gibbs, get_expected_image
+
+    n_colors = 2
+    # J that pushes every pixel toward 0, and its mirror image toward 1
+    J = 1 * np.ones([n_colors, n_colors])
+    J[0, 0] = 5
+    J[1, 1] = 0
+    J_batch = np.stack([J, J[::-1, ::-1], J])
+
+    np.random.seed(0)
+    images = np.random.randint(0, n_colors, size=(3, 10, 12))
+    for schedule in ["checkerboard", "sequential"]:
+        samples = run_gibbs(images, 20, n_colors=n_colors, J=J_batch,
+                            schedule=schedule)
+        assert samples[0].shape == images.shape
+        image = get_expected_image(samples, burnin=15, sample_every=1)
+        assert image.shape == images.shape
+        assert np.mean(image[0]) < 0.05
+        assert np.mean(image[1]) > 0.95
+        assert np.mean(image[2]) < 0.05
+
+
+def test_gibbs_swendsen_wang():
+    import itertools
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs
+
+    # default_J for 3 colors has unequal off-diagonal entries, which takes
+    #   the round-by-round cluster update; 2 colors recolors all at once
+    for n_colors, shape in [(2, (3, 3)), (3, (2, 3))]:
+        J = default_J(n_colors=n_colors)
+        mu = default_mu(n_colors=n_colors) / 2
+
+        np.random.seed(0)
+        random_image = np.random.randint(0, n_colors, size=shape)
+        samples = run_gibbs(random_image, 3000, n_colors=n_colors, J=J, mu=mu,
+                            schedule="swendsen_wang")
+        assert len(samples) == 3000
+        assert samples[0].shape == shape
+
+        total, marginal = 0, np.zeros(shape + (n_colors,))
+        for bits in itertools.product(range(n_colors), repeat=np.prod(shape)):
+            z = np.array(bits).reshape(shape)
+            weight = np.exp(J[z[:-1], z[1:]].sum() + J[z[:, :-1], z[:, 1:]].sum()
+                            + mu[z, random_image].sum())
+            total += weight
+            marginal += weight * np.eye(n_colors)[z]
+        marginal /= total
+
+        empirical = np.eye(n_colors)[np.stack(samples[100:])].mean(axis=0)
+        assert np.max(np.abs(empirical - marginal)) < 0.05
+
+
+def test_gibbs_diagnostics():
+    from src.potentials import default_J, default_mu, image_energy
+    from src.diagnostics import GibbsDiagnostics, split_rhat
+    from src.gibbs import run_gibbs
+
+    n_colors = 2
+    J, mu = default_J(n_colors=n_colors), default_mu(n_colors=n_colors)
+
+    np.random.seed(0)
+    images = np.random.randint(0, n_colors, size=(2, 5, 6))
+    z = images[0]
+    energy = -(J[z[:-1], z[1:]].sum() + J[z[:, :-1], z[:, 1:]].sum()
+               + mu[z, images[1]].sum())
+    assert np.isclose(image_energy(z, images[1], J=J, mu=mu), energy)
+    assert np.allclose(image_energy(images, images, J=J, mu=mu),
+                       [image_energy(x, x, J=J, mu=mu) for x in images])
+
+    # Stationary traces pass, traces stuck at different levels don't
+    assert split_rhat(np.random.randn(4, 100)) < 1.1
+    assert split_rhat(np.random.randn(4, 100) + np.arange(4)[:, None]) > 1.5
+
+    # An easy image converges long before the cap
+    image = np.zeros((16, 16), dtype=int)
+    image[4:12, 4:12] = 1
+    diagnostics = GibbsDiagnostics(min_iter=20)
+    samples = run_gibbs(image, 500, n_colors=n_colors, J=J, mu=mu,
+                        schedule="checkerboard", keep="thinned",
+                        sample_every=2, diagnostics=diagnostics,
+                        stop_when_converged=True)
+    n_sweeps = len(diagnostics.energy)
+    assert diagnostics.converged and 20 <= n_sweeps < 500
+    assert diagnostics.burnin == n_sweeps // 2
+    assert len(samples) == len(range(diagnostics.burnin, n_sweeps, 2))
+    assert len(diagnostics.flip_fraction) == n_sweeps
+
+    # Chains from a pool are merged into one object
+    diagnostics = GibbsDiagnostics()
+    run_gibbs(image, 30, n_colors=n_colors, J=J, mu=mu, schedule="checkerboard",
+              n_chains=2, n_workers=1, keep="none", diagnostics=diagnostics)
+    assert len(diagnostics.chains) == 2
+    assert all(len(chain.energy) == 30 for chain in diagnostics.chains)
+    assert np.isfinite(diagnostics.split_rhat())
+
+
+def test_gibbs_packed_samples():
+    from src.data import get_color_idxs
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs, get_expected_image, PackedSamples
+
+    n_colors = 2
+    kwargs = dict(n_colors=n_colors, J=default_J(n_colors=n_colors),
+                  mu=default_mu(n_colors=n_colors), schedule="checkerboard")
+
+    assert get_color_idxs(np.array([[0, 255], [100, 200]])).dtype == np.uint8
+
+    np.random.seed(0)
+    random_image = np.random.randint(0, n_colors, size=(9, 13))
+    np.random.seed(1)
+    plain = run_gibbs(random_image, 10, **kwargs)
+    np.random.seed(1)
+    packed = run_gibbs(random_image, 10, pack=True, **kwargs)
+
+    assert plain[0].dtype == np.uint8
+    assert isinstance(packed, PackedSamples) and len(packed) == 10
+    assert packed.nbytes == 10 * int(np.ceil(random_image.size / 8))
+    assert all(np.all(x == y) for x, y in zip(plain, packed))
+    assert np.all(get_expected_image(packed, burnin=4, sample_every=2)
+                  == get_expected_image(plain, burnin=4, sample_every=2))
+
+    chains = run_gibbs(random_image, 6, pack=True, n_chains=2, n_workers=1,
+                       keep="thinned", burnin=2, **kwargs)
+    assert all(isinstance(chain, PackedSamples) for chain in chains)
+    assert get_expected_image(chains, burnin=0).shape == random_image.shape
+
+
+def test_gibbs_rng_streams():
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs
+
+    n_colors = 2
+    kwargs = dict(n_colors=n_colors, J=default_J(n_colors=n_colors),
+                  mu=default_mu(n_colors=n_colors))
+    images = np.random.randint(0, n_colors, size=(3, 6, 7))
+
+    for schedule in ["sequential", "checkerboard", "swendsen_wang"]:
+        # The same seed gives the same chain, whatever the global state
+        np.random.seed(0)
+        first = run_gibbs(images[0], 4, schedule=schedule, rng=5, **kwargs)
+        np.random.seed(1)
+        second = run_gibbs(images[0], 4, schedule=schedule, rng=5, **kwargs)
+        assert all(np.all(x == y) for x, y in zip(first, second))
+
+        # Each image in a stack uses its own spawned stream
+        stack = run_gibbs(images, 4, schedule=schedule,
+                          rng=np.random.default_rng(7), **kwargs)
+        children = np.random.default_rng(7).spawn(len(images))
+        for n, child in enumerate(children):
+            alone = run_gibbs(images[n], 4, schedule=schedule, rng=child, **kwargs)
+            assert all(np.all(x[n] == y) for x, y in zip(stack, alone))
+
+    # Sequential stacks are swept together, also with per-image parameters
+    #   and with too many colors for the lookup tables
+    for n_colors in [3, 6]:
+        colored = np.random.randint(0, n_colors, size=(3, 6, 7))
+        J = np.stack([default_J(n_colors) * (n + 1) for n in range(3)])
+        mu = default_mu(n_colors)
+        stack = run_gibbs(colored, 3, n_colors=n_colors, J=J, mu=mu, rng=7)
+        children = np.random.default_rng(7).spawn(len(colored))
+        for n, child in enumerate(children):
+            alone = run_gibbs(colored[n], 3, n_colors=n_colors, J=J[n], mu=mu, rng=child)
+            assert all(np.all(x[n] == y) for x, y in zip(stack, alone))
+
+    # Chains don't depend on how many workers run them
+    chains = [run_gibbs(images[0], 5, schedule="checkerboard", n_chains=3,
+                        n_workers=n_workers, rng=11, **kwargs)
+              for n_workers in [1, 3]]
+    for x, y in zip(*chains):
+        assert all(np.all(a == b) for a, b in zip(x, y))
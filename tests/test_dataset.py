@@ -0,0 +1,39 @@
+import numpy as np
+from PIL import Image
+
+
+def test_load_dataset(tmp_path, monkeypatch):
+    from src import dataset
+    from src.data import quantize, get_color_idxs
+    from src.dataset import list_images, load_dataset
+
+    folder = tmp_path / "digits"
+    folder.mkdir()
+    np.random.seed(0)
+    images = np.random.randint(0, 256, size=(11, 6, 5)).astype(np.uint8)
+    for i, arr in enumerate(images):
+        Image.fromarray(arr, mode="L").save(folder / f"{i}.png")
+
+    paths = list_images("digits", root=tmp_path)
+    assert [p.split("/")[-1] for p in paths[:3]] == ["0.png", "1.png", "2.png"]
+    assert paths[-1].endswith("10.png")
+
+    grey = load_dataset("digits", root=tmp_path)
+    assert isinstance(grey, np.memmap) and grey.dtype == np.uint8
+    assert np.all(grey == images)
+
+    colors = load_dataset("digits", n_colors=3, root=tmp_path)
+    expected = [get_color_idxs(np.array(quantize(Image.fromarray(arr), 3)), 3)
+                for arr in images]
+    assert np.all(colors == np.stack(expected))
+
+    # Unchanged folders are served from the cache without decoding anything
+    def fail(*args, **kwargs):
+        raise AssertionError("decoded an image")
+    monkeypatch.setattr(dataset, "_decode", fail)
+    assert np.all(load_dataset("digits", root=tmp_path) == images)
+    monkeypatch.undo()
+
+    # A new image invalidates the cache
+    Image.fromarray(images[0], mode="L").save(folder / "11.png")
+    assert load_dataset("digits", root=tmp_path).shape == (12, 6, 5)
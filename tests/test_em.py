@@ -41,3 +41,81 @@ def test_em():
     assert np.mean(Js) > 0.25, "EM should learn new J matrix"
     assert np.mean(mus) > 0.25, "EM should learn new mu matrix"
     assert np.mean(mses) > 0.4, "EM should learn different images than Gibbs alone"
+
+
+def test_em_batch():
+    from src.potentials import default_J, default_mu
+    from src.em import run_em
+
+    n_colors = 2
+    np.random.seed(0)
+    images = np.random.randint(0, n_colors, size=(4, 10, 10))
+    kwargs = dict(n_colors=n_colors, n_gibbs_iters=6, n_em_iters=3, burnin=2,
+                  J=default_J(n_colors), mu=default_mu(n_colors),
+                  schedule="checkerboard")
+
+    samples, extra_info = run_em(images, **kwargs)
+    assert len(samples) == 3
+    assert samples[-1].shape == images.shape
+    assert extra_info["J"].shape == (n_colors, n_colors)
+    assert extra_info["mu"].shape == (n_colors, n_colors)
+
+    samples, extra_info = run_em(images, keep="all", **kwargs)
+    assert len(extra_info["gibbs_samples"]) == 6
+
+    samples, extra_info = run_em(images, share_params=False, **kwargs)
+    assert samples[-1].shape == images.shape
+    assert extra_info["J"].shape == (4, n_colors, n_colors)
+    assert extra_info["mu"].shape == (4, n_colors, n_colors)
+
+
+def test_em_early_stopping():
+    from src.potentials import default_J, default_mu
+    from src.em import run_em
+
+    n_colors = 2
+    np.random.seed(0)
+    image = np.zeros((16, 16), dtype=int)
+    image[4:12, 4:12] = 1
+    noisy = np.where(np.random.rand(*image.shape) < 0.05, 1 - image, image)
+    kwargs = dict(n_colors=n_colors, n_em_iters=20, J=default_J(n_colors),
+                  mu=default_mu(n_colors), inference="mean_field")
+
+    samples, extra_info = run_em(noisy, **kwargs)
+    history = extra_info["history"]
+    assert len(samples) == 20
+    assert all(len(values) == 20 for values in history.values())
+    assert np.all(np.diff(history["time"]) >= 0)
+    assert history["n_changed"][0] == np.sum(samples[0] != noisy)
+    assert np.all(history["J"][-1] == extra_info["J"])
+
+    samples, extra_info = run_em(noisy, param_tol=1e-3, pixel_tol=0, **kwargs)
+    history = extra_info["history"]
+    assert len(samples) < 20
+    assert history["n_changed"][-1] == 0
+    assert max(history["J_change"][-1], history["mu_change"][-1]) < 1e-3
+
+    # Converged Gibbs E-steps end before a small cap
+    samples, extra_info = run_em(
+        noisy, n_colors=n_colors, n_em_iters=3, n_gibbs_iters=30,
+        J=default_J(n_colors), mu=default_mu(n_colors), schedule="checkerboard",
+        stop_when_converged=True, rng=0)
+    diagnostics = extra_info["diagnostics"]
+    assert all(d.min_iter == 15 for d in diagnostics)
+    assert any(len(d.energy) < 30 for d in diagnostics)
+
+
+def test_em_keep():
+    from src.gibbs import KEEP
+    from src.potentials import default_J, default_mu
+    from src.em import run_em
+
+    np.random.seed(0)
+    noisy = np.random.randint(0, 2, size=(12, 12))
+    for keep in KEEP:
+        samples, extra_info = run_em(
+            noisy, n_em_iters=2, n_gibbs_iters=6, burnin=2, sample_every=1,
+            J=default_J(2), mu=default_mu(2), keep=keep, rng=0)
+        assert len(samples) == 2 and samples[-1].shape == noisy.shape
+        n_kept = {"all": 6, "thinned": 4, "last": 1, "none": 0}[keep]
+        assert len(extra_info["gibbs_samples"]) == n_kept
@@ -0,0 +1,37 @@
+import itertools
+import numpy as np
+import pytest
+
+
+def test_map_graphcut():
+    from src.potentials import default_J, default_mu, image_energy
+    from src.graphcut import map_graphcut
+    from src.icm import run_icm
+
+    np.random.seed(0)
+    shape = (3, 4)
+    configs = [np.array(bits).reshape(shape)
+               for bits in itertools.product(range(2), repeat=12)]
+    for _ in range(5):
+        noisy = np.random.randint(0, 2, size=shape)
+        # Random submodular J: make the diagonal outweigh the off-diagonal
+        J = np.random.randn(2, 2)
+        J[1, 1] += max(0, J[0, 1] + J[1, 0] - J[0, 0] - J[1, 1]) + 0.1
+        mu = np.random.randn(2, 2)
+
+        energies = [image_energy(z, noisy, J, mu) for z in configs]
+        best = configs[int(np.argmin(energies))]
+        image = map_graphcut(noisy, J, mu, beta=0.5)
+        assert image.dtype == np.uint8
+        assert np.isclose(image_energy(image, noisy, J, mu), min(energies))
+        assert np.all(image == best)
+
+    # Never worse than ICM, and stacks are handled image by image
+    J, mu = default_J(2), default_mu(2)
+    noisy = np.random.randint(0, 2, size=(2, 20, 30))
+    images = map_graphcut(noisy, J, mu)
+    icm, _ = run_icm(noisy, n_colors=2, J=J, mu=mu)
+    assert np.all(image_energy(images, noisy, J, mu) <= image_energy(icm, noisy, J, mu) + 1e-9)
+
+    with pytest.raises(ValueError, match="submodular"):
+        map_graphcut(noisy[0], -J, mu)
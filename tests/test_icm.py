@@ -0,0 +1,73 @@
+import numpy as np
+from src.utils import mean_squared_error
+
+
+def test_icm():
+    from src.potentials import default_J, default_mu, image_energy, potts_conditionals
+    from src.icm import run_icm
+
+    n_colors = 2
+    J, mu = default_J(n_colors), default_mu(n_colors)
+    image_arr = np.zeros((24, 20), dtype=int)
+    image_arr[4:16, 3:12] = 1
+    np.random.seed(0)
+    flip = np.random.random_sample(image_arr.shape) < 0.1
+    noisy_arr = np.where(flip, 1 - image_arr, image_arr)
+
+    image, info = run_icm(noisy_arr, n_colors=n_colors, J=J, mu=mu)
+    assert image.dtype == np.uint8 and image.shape == noisy_arr.shape
+    assert info["converged"] and info["n_iter"] <= 10
+    assert info["n_changed"][-1] == 0
+    assert 2 * mean_squared_error(image_arr, image) < mean_squared_error(image_arr, noisy_arr)
+    assert image_energy(image, noisy_arr, J, mu) < image_energy(noisy_arr, noisy_arr, J, mu)
+
+    # Every pixel already has its most likely color given its neighbors
+    probs = potts_conditionals(image, noisy_arr, J=J, mu=mu, n_colors=n_colors)
+    current = np.take_along_axis(probs, image[..., None].astype(int), axis=-1)[..., 0]
+    assert np.all(current >= probs.max(axis=-1))
+
+    annealed, _ = run_icm(noisy_arr, n_colors=n_colors, J=J, mu=mu, anneal=True, rng=0)
+    again, _ = run_icm(noisy_arr, n_colors=n_colors, J=J, mu=mu, anneal=True, rng=0)
+    assert np.all(annealed == again)
+    assert 2 * mean_squared_error(image_arr, annealed) < mean_squared_error(image_arr, noisy_arr)
+
+    stack = np.stack([noisy_arr, 1 - noisy_arr])
+    images, _ = run_icm(stack, n_colors=n_colors, J=J, mu=mu)
+    assert np.all(images[0] == image) and np.all(images[1] == 1 - image)
+
+
+def test_em_icm(noisy_square):
+    from src.potentials import default_J, default_mu, image_energy, potts_conditionals
+    from src.em import run_em
+    from src.icm import run_icm
+
+    n_colors = 2
+    _, noisy_arr = noisy_square()
+
+    results = {}
+    for inference in ["icm", "anneal", "graphcut"]:
+        samples, extra_info = run_em(
+            noisy_arr, n_colors=n_colors, n_em_iters=3, J=default_J(n_colors),
+            mu=default_mu(n_colors), inference=inference, rng=0)
+        assert len(samples) == 3
+        assert "gibbs_samples" not in extra_info
+        # The parameters the last E-step ran with
+        J, mu = extra_info["history"]["J"][-2], extra_info["history"]["mu"][-2]
+        results[inference] = samples[-1], J, mu
+
+    # ICM stops at a local optimum: no single pixel wants to change
+    image, J, mu = results["icm"]
+    probs = potts_conditionals(image, noisy_arr, J=J, mu=mu, n_colors=n_colors)
+    current = np.take_along_axis(probs, image[..., None].astype(int), axis=-1)[..., 0]
+    assert np.all(current >= probs.max(axis=-1))
+
+    # Annealing is reproducible from its random stream
+    image, _, _ = results["anneal"]
+    again, _ = run_em(noisy_arr, n_colors=n_colors, n_em_iters=3, J=default_J(n_colors),
+                      mu=default_mu(n_colors), inference="anneal", rng=0)
+    assert np.all(again[-1] == image)
+
+    # The min cut is the exact MAP, so ICM can't find a lower energy
+    image, J, mu = results["graphcut"]
+    local, _ = run_icm(noisy_arr, n_colors=n_colors, J=J, mu=mu)
+    assert image_energy(image, noisy_arr, J, mu) <= image_energy(local, noisy_arr, J, mu) + 1e-9
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def test_timings():
+    import tracemalloc
+    from src.potentials import default_J, default_mu
+    from src.gibbs import run_gibbs
+    from src.em import run_em
+    from src.instrument import Timings, timed
+
+    n_colors = 2
+    kwargs = dict(n_colors=n_colors, J=default_J(n_colors), mu=default_mu(n_colors),
+                  schedule="checkerboard")
+    np.random.seed(0)
+    image = np.random.randint(0, n_colors, size=(8, 9))
+
+    timings = Timings()
+    run_gibbs(image, 4, callback=timings, **kwargs)
+    assert [e["iteration"] for e in timings.events] == [0, 1, 2, 3]
+    assert all(e["phase"] == "sweep" and e["pixels"] == image.size
+               and e["seconds"] >= 0 and e["bytes"] is None for e in timings.events)
+
+    events = []
+    _, extra_info = run_em(image, n_em_iters=2, n_gibbs_iters=3, burnin=1,
+                           sample_every=1, callback=events.append, **kwargs)
+    summary = extra_info["timings"]
+    assert {e["phase"] for e in events} == set(summary)
+    assert set(summary) == {"sweep", "e_step", "m_step", "calculate_J", "calculate_mu"}
+    assert summary["sweep"]["count"] == 6 and summary["e_step"]["count"] == 2
+    assert summary["e_step"]["pixels"] == 6 * image.size
+    assert summary["e_step"]["seconds"] >= summary["sweep"]["seconds"]
+
+    # With tracemalloc on, an inner phase's allocations count toward the outer
+    timings = Timings()
+    tracemalloc.start()
+    try:
+        with timed(timings, "outer"):
+            with timed(timings, "inner"):
+                x = np.ones(10 ** 6)
+                del x
+    finally:
+        tracemalloc.stop()
+    inner, outer = timings.events
+    assert inner["bytes"] >= 8 * 10 ** 6
+    assert outer["bytes"] >= inner["bytes"]
+
+
+def test_timed_keeps_global_peak():
+    import tracemalloc
+    from src.instrument import Timings, clear_peak, peak_traced_memory, timed
+
+    timings = Timings()
+    tracemalloc.start()
+    clear_peak()
+    try:
+        with timed(timings, "big"):
+            big = np.ones(10 * 2 ** 20 // 8)
+            del big
+        with timed(timings, "empty"):
+            pass
+        peak = peak_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert timings.events[0]["bytes"] >= 10 * 2 ** 20
+    assert timings.events[1]["bytes"] < 2 ** 20
+    assert peak >= 10 * 2 ** 20
+    assert peak_traced_memory() is None
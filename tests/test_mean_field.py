@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def test_mean_field():
+    from src.potentials import default_J, default_mu, conditionals_from_counts
+    from src.mean_field import run_mean_field
+    from src.utils import get_neighborhood
+
+    n_colors = 3
+    J, mu = default_J(n_colors), default_mu(n_colors)
+    np.random.seed(0)
+    noisy = np.random.randint(0, n_colors, size=(8, 9))
+
+    for schedule, damping in [("parallel", 0.5), ("checkerboard", 0)]:
+        q, info = run_mean_field(noisy, n_colors, beta=0.5, J=J, mu=mu,
+                                 n_iter=200, tol=1e-8, damping=damping,
+                                 schedule=schedule)
+        assert info["converged"]
+        assert info["n_iter"] < 200
+        assert q.shape == (8, 9, n_colors)
+        assert np.allclose(q.sum(axis=-1), 1)
+
+        # Converged marginals are a fixed point of the mean-field update
+        expected = get_neighborhood(noisy.shape).neighbor_sum(q)
+        update = conditionals_from_counts(expected, noisy, 0.5, J, mu)
+        assert np.allclose(q, update, atol=1e-6)
+
+
+def test_em_mean_field(noisy_square):
+    from src.potentials import default_J, default_mu, conditionals_from_counts
+    from src.em import run_em
+    from src.utils import get_neighborhood
+
+    n_colors = 2
+    _, noisy_arr = noisy_square()
+
+    samples, extra_info = run_em(
+        noisy_arr, n_colors=n_colors, n_em_iters=3, J=default_J(n_colors),
+        mu=default_mu(n_colors), inference="mean_field", inference_tol=1e-8,
+        n_inference_iters=500)
+    assert len(samples) == 3
+    assert "gibbs_samples" not in extra_info
+    q = extra_info["marginals"]
+    assert q.shape == (20, 20, n_colors)
+    assert np.all(samples[-1] == np.argmax(q, axis=-1))
+
+    # The marginals are a fixed point under the last E-step's parameters
+    J, mu = extra_info["history"]["J"][-2], extra_info["history"]["mu"][-2]
+    expected = get_neighborhood(noisy_arr.shape).neighbor_sum(q)
+    assert np.allclose(q, conditionals_from_counts(expected, noisy_arr, 1, J, mu),
+                       atol=1e-6)
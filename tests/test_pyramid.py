@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def test_pyramid():
+    from src.pyramid import build_pyramid, downsample, upsample
+
+    arr = np.array([[0, 1, 1, 2, 2],
+                    [0, 0, 1, 2, 2],
+                    [1, 1, 0, 0, 0]])
+    coarse = downsample(arr, n_colors=3)
+    assert coarse.dtype == np.uint8
+    assert np.all(coarse == [[0, 1, 2], [1, 0, 0]])
+    assert np.all(upsample(coarse, arr.shape) == [[0, 0, 1, 1, 2],
+                                                   [0, 0, 1, 1, 2],
+                                                   [1, 1, 0, 0, 0]])
+    marginals = np.random.random_sample((2, 3, 4))
+    assert upsample(marginals, (3, 5), axes=(-3, -2)).shape == (3, 5, 4)
+
+    levels = build_pyramid(np.zeros((3, 100, 70), dtype=np.uint8), n_levels=5)
+    assert [level.shape for level in levels] == [
+        (3, 100, 70), (3, 50, 35), (3, 25, 18), (3, 13, 9)]
+
+
+def test_em_pyramid(noisy_square):
+    from src.em import run_em
+    from src.gibbs import run_gibbs
+    from src.potentials import default_J, default_mu
+
+    _, noisy_arr = noisy_square(64)
+
+    # The chain starts from `init` but conditions on `orig_arr`
+    init = np.zeros_like(noisy_arr)
+    for n_chains in [1, 2]:
+        samples = run_gibbs(noisy_arr, 1, J=default_J(2), mu=default_mu(2),
+                            init=init, n_chains=n_chains, rng=0)
+        first = samples[0][0] if n_chains > 1 else samples[0]
+        assert np.sum(first != noisy_arr) > np.sum(first != init)
+
+    for inference in ["gibbs", "mean_field", "icm"]:
+        samples, extra_info = run_em(
+            noisy_arr, n_em_iters=2, n_gibbs_iters=6, burnin=2,
+            J=default_J(2), mu=default_mu(2), schedule="checkerboard",
+            inference=inference, n_levels=3, rng=0)
+        assert len(samples) == 2 and samples[-1].shape == noisy_arr.shape
+        assert extra_info["coarse"]["coarse"]["J"].shape == (2, 2)
+        assert "coarse" not in extra_info["coarse"]["coarse"]
+        # Each level runs on an image half as wide as the one above it
+        assert extra_info["timings"]["coarse_level"]["pixels"] == 32 * 32
+        assert extra_info["coarse"]["timings"]["coarse_level"]["pixels"] == 16 * 16
+        assert "coarse_level" not in extra_info["coarse"]["coarse"]["timings"]
@@ -0,0 +1,36 @@
+import csv
+import json
+import numpy as np
+from PIL import Image
+
+
+def test_sweep(tmp_path):
+    from free_response.sweep import make_grid, run_sweep, write_results
+
+    rng = np.random.default_rng(0)
+    (tmp_path / "mnist").mkdir()
+    for i in range(2):
+        arr = np.zeros((16, 16), dtype=np.uint8)
+        arr[3:12, 4 + i:10 + i] = 255
+        Image.fromarray(arr, mode="L").save(tmp_path / "mnist" / f"{i}.png")
+
+    configs = make_grid({"img": [0, 1], "beta": [0.5, 1], "n_em_iters": [2],
+                         "schedule": ["checkerboard"]})
+    assert len(configs) == 4
+    assert [(c["img"], c["beta"]) for c in configs] == [(0, 0.5), (0, 1), (1, 0.5), (1, 1)]
+    assert configs[0]["noise"] == 0.1 and configs[0]["n_gibbs_iters"] == 5
+
+    serial = run_sweep(configs, n_workers=1, root=str(tmp_path))
+    pooled = run_sweep(configs, n_workers=2, root=str(tmp_path))
+    assert [row["mse"] for row in serial] == [row["mse"] for row in pooled]
+    assert serial[0]["n_em_iters_run"] == 2
+    assert np.array(serial[0]["J"]).shape == (2, 2)
+    assert all(row["noisy_mse"] > 0 and row["seconds"] > 0 for row in serial)
+
+    write_results(serial, str(tmp_path / "results.json"))
+    with open(tmp_path / "results.json") as f:
+        assert json.load(f)[1]["beta"] == 1
+    write_results(serial, str(tmp_path / "results.csv"))
+    with open(tmp_path / "results.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 4 and json.loads(rows[0]["mu"]) == serial[0]["mu"]
@@ -0,0 +1,51 @@
+import itertools
+import numpy as np
+
+
+def test_tempering():
+    from src.potentials import default_J, default_mu, image_energy
+    from src.tempering import run_tempering
+
+    # On a tiny image, the target replica matches the exact marginals, also
+    #   for an asymmetric J (which image_energy symmetrizes)
+    rng = np.random.default_rng(0)
+    J = rng.normal(size=(2, 2))
+    mu = rng.normal(size=(2, 2))
+    noisy = rng.integers(0, 2, size=(2, 3))
+    beta = 1.5
+    weights = []
+    images = []
+    for bits in itertools.product(range(2), repeat=noisy.size):
+        z = np.array(bits).reshape(noisy.shape)
+        images.append(z)
+        weights.append(np.exp(-beta * image_energy(z, noisy, J, mu)))
+    exact = np.average(images, axis=0, weights=weights)
+
+    samples, info = run_tempering(noisy, 1000, beta=beta, betas=[1.5, 1, 0.5],
+                                  J=J, mu=mu, n_workers=1, keep="thinned",
+                                  burnin=100, rng=0)
+    assert len(samples) == 900
+    assert np.all(info["n_proposed"] == 500)
+    assert np.all((info["acceptance"] > 0.2) & (info["acceptance"] < 1))
+    assert np.allclose(np.mean(samples, axis=0), exact, atol=0.05)
+
+    # The worker pool doesn't change the results
+    noisy = rng.integers(0, 2, size=(16, 16))
+    kwargs = dict(J=default_J(2), mu=default_mu(2), swap_every=2, rng=1)
+    serial, serial_info = run_tempering(noisy, 6, n_workers=1, **kwargs)
+    pooled, pooled_info = run_tempering(noisy, 6, n_workers=2, **kwargs)
+    assert len(serial) == 6 and serial[0].dtype == np.uint8
+    assert all(np.array_equal(a, b) for a, b in zip(serial, pooled))
+    assert np.array_equal(serial_info["energies"], pooled_info["energies"])
+
+    # Keeping nothing still runs exactly n_iter sweeps
+    _, kept_none = run_tempering(noisy, 5, n_workers=1, keep="none", **kwargs)
+    _, kept_all = run_tempering(noisy, 5, n_workers=1, **kwargs)
+    assert np.array_equal(kept_none["energies"], kept_all["energies"])
+
+    # Stacks swap per image
+    stack = np.stack([noisy, 1 - noisy])
+    samples, info = run_tempering(stack, 3, n_workers=1, keep="last", **kwargs)
+    assert len(samples) == 1 and samples[0].shape == stack.shape
+    assert info["energies"][-1].shape == (4, 2)
+    assert np.all(info["n_proposed"] <= 2)
@@ -0,0 +1,49 @@
+import numpy as np
+from src.utils import mean_squared_error
+
+
+def test_iter_tiles():
+    from src.tiling import iter_tiles
+
+    covered = np.zeros((23, 17), dtype=int)
+    for outer, inner in iter_tiles(covered.shape, tile_size=8, halo=3):
+        region = covered[outer]
+        assert region.shape[0] <= 8 + 2 * 3 and region.shape[1] <= 8 + 2 * 3
+        region[inner] += 1
+    assert np.all(covered == 1), "Every pixel is in exactly one tile interior"
+
+
+def test_denoise_tiled(tmp_path):
+    from src.data import add_noise, get_color_idxs, color_idxs_to_image
+    from src.potentials import default_J, default_mu
+    from src.tiling import open_noisy, save_color_idxs, denoise_tiled
+
+    n_colors = 2
+    image_arr = np.zeros((40, 50), dtype=int)
+    image_arr[10:30, 5:20] = 1
+    image_arr[5:35, 30:45] = 1
+
+    np.random.seed(0)
+    noisy_image = add_noise(color_idxs_to_image(image_arr, n_colors), 0.1,
+                            n_colors=n_colors)
+    noisy_arr = get_color_idxs(np.array(noisy_image), n_colors)
+    noisy = open_noisy(save_color_idxs(noisy_image, tmp_path / "noisy.npy",
+                                       n_colors=n_colors, rows_per_chunk=7).filename)
+    assert isinstance(noisy, np.memmap)
+    assert np.all(noisy == noisy_arr)
+
+    kwargs = dict(n_colors=n_colors, tile_size=16, halo=4, n_gibbs_iters=10,
+                  burnin=5, J=default_J(n_colors), mu=default_mu(n_colors))
+    out = denoise_tiled(noisy, tmp_path / "out.npy", **kwargs)
+    assert np.all(np.load(tmp_path / "out.npy") == out)
+    assert 2 * mean_squared_error(image_arr, out) < mean_squared_error(image_arr, noisy_arr)
+
+    # PIL images are read one tile at a time
+    out = denoise_tiled(noisy_image, np.zeros(image_arr.shape, dtype=int),
+                        method="em", n_em_iters=2, **kwargs)
+    assert 2 * mean_squared_error(image_arr, out) < mean_squared_error(image_arr, noisy_arr)
+
+    # Each tile has its own stream, so a seed fixes the result
+    first = denoise_tiled(noisy, np.zeros(image_arr.shape, dtype=int), rng=3, **kwargs)
+    second = denoise_tiled(noisy_image, np.zeros(image_arr.shape, dtype=int), rng=3, **kwargs)
+    assert np.all(first == second)